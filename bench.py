@@ -0,0 +1,323 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import pygame
+
+import blend
+import filters
+from main import DrawingEngine, Tool
+
+SIZES = {
+    "800x600": (800, 600),
+    "1080p": (1920, 1080),
+    "4k": (3840, 2160),
+}
+LAYER_COUNTS = [1, 4, 16]
+
+
+def stroke_points(engine, count=200):
+    # a zig-zag across most of the canvas
+    points = []
+    for i in range(count):
+        x = int(engine.width * (0.05 + 0.9 * i / (count - 1)))
+        y = int(engine.height * (0.2 if i % 2 else 0.8))
+        points.append((x, y))
+    return points
+
+
+def stroke(engine, tool, points):
+    engine.current_tool = tool
+    engine.save_state()
+    engine.last_pos = None
+    engine.draw_stroke(points[:1])
+    engine.draw_stroke(points[1:])
+    engine.last_pos = None
+    engine.commit_state()
+
+
+def bench_flood_fill(engine, workdir):
+    colors = [(255, 0, 0), (0, 0, 255)]
+    state = {"i": 0}
+
+    def run():
+        engine.color = colors[state["i"] % 2]
+        state["i"] += 1
+        engine.flood_fill((engine.width // 2, engine.height // 2))
+    return run
+
+
+def bench_gradient(engine, workdir):
+    def run():
+        engine.current_tool = Tool.GRADIENT
+        engine.start_shape((0, 0))
+        engine.finish_shape((engine.width - 1, engine.height - 1))
+    return run
+
+
+def bench_stroke(tool):
+    def setup(engine, workdir):
+        points = stroke_points(engine)
+        engine.brush_size = 40
+        return lambda: stroke(engine, tool, points)
+    return setup
+
+
+def bench_spray(engine, workdir):
+    points = stroke_points(engine)
+    engine.brush_size = 40
+    engine.seed_spray(0)
+    return lambda: stroke(engine, Tool.SPRAY, points)
+
+
+def bench_selected_stroke(engine, workdir):
+    # a brush stroke across the canvas that only lands inside an elliptical
+    # selection around the middle
+    points = stroke_points(engine)
+    engine.brush_size = 40
+    engine.select("ellipse", (engine.width // 4, engine.height // 4), (engine.width * 3 // 4, engine.height * 3 // 4))
+    return lambda: stroke(engine, Tool.BRUSH, points)
+
+
+def bench_undo_redo(engine, workdir):
+    engine.brush_size = 40
+    stroke(engine, Tool.BRUSH, stroke_points(engine))
+
+    def run():
+        engine.undo()
+        engine.redo()
+    return run
+
+
+def bench_save_state(engine, workdir):
+    # the undo bookkeeping around an edit, keyframes included: beginning and
+    # journaling a stroke that was drawn once beforehand, not drawing it
+    points = stroke_points(engine, 20)
+    engine.brush_size = 40
+    stroke(engine, Tool.PENCIL, points)
+    segments = [points[:1], points[1:]]
+
+    def run():
+        engine.save_state()
+        engine.stroke_segments = list(segments)
+        engine.history.touch()
+        engine.commit_state()
+    return run
+
+
+def bench_composite(engine, workdir):
+    def run():
+        engine.compositor.invalidate()
+        engine.compositor.compose(engine.screen, engine.layers, engine.active_layer, engine.viewport)
+    return run
+
+
+def bench_frame(engine, workdir):
+    # the steady-state cost of a frame that recomposites the whole canvas
+    def run():
+        engine.compositor.mark_all()
+        engine.compositor.compose(engine.screen, engine.layers, engine.active_layer, engine.viewport)
+    return run
+
+
+def bench_zoomed_out(engine, workdir):
+    # a full redraw at 1/8 zoom once the mip tiles are built
+    engine.viewport.zoom_at((0, 0), -3)
+    engine.compositor.budget = float("inf")
+    engine.compositor.compose(engine.screen, engine.layers, engine.active_layer, engine.viewport)
+
+    def run():
+        engine.compositor.mark_all()
+        engine.compositor.compose(engine.screen, engine.layers, engine.active_layer, engine.viewport)
+    return run
+
+
+def bench_flatten_blended(engine, workdir):
+    # flattening a stack whose layers all use blend modes and opacity, on
+    # the NumPy path and the blend thread pool
+    modes = blend.MODES[1:]
+    for i, layer in enumerate(engine.layers):
+        layer.blend_mode = modes[i % len(modes)]
+        layer.opacity = 0.75
+
+    def run():
+        blend.flatten(engine.layers, (0, 0, engine.width, engine.height))
+    return run
+
+
+def bench_filter(engine, workdir):
+    # blurring the whole active layer, split into tiles over the filter
+    # process pool
+    def run():
+        filters.apply(engine.layers[engine.active_layer], filters.Filter.GAUSSIAN_BLUR, 8, engine.layers[0].get_rect())
+    return run
+
+
+def bench_startup(engine, workdir):
+    # the editor started in a fresh process and quit after its first frame
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"),
+               "--startup", "--size", f"{engine.width}x{engine.height}"]
+    env = dict(os.environ, SDL_VIDEODRIVER="dummy")
+    return lambda: subprocess.run(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                  check=True)
+
+
+def bench_save_drawing(engine, workdir):
+    path = os.path.join(workdir, "bench.png")
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            engine.save_drawing(path)
+        engine.exporter.wait()
+    return run
+
+
+def bench_save_project(engine, workdir):
+    # an incremental save after a small edit to an already saved project
+    path = os.path.join(workdir, "bench.fdp")
+    with contextlib.redirect_stdout(io.StringIO()):
+        engine.save_project(path)
+    points = [(engine.width // 2, engine.height // 2), (engine.width // 2 + 10, engine.height // 2)]
+
+    def run():
+        stroke(engine, Tool.PENCIL, points)
+        with contextlib.redirect_stdout(io.StringIO()):
+            engine.save_project(path)
+    return run
+
+
+# name -> (setup, whether it depends on the layer count)
+BENCHMARKS = {
+    "flood_fill": (bench_flood_fill, False),
+    "gradient": (bench_gradient, False),
+    "brush_stroke": (bench_stroke(Tool.BRUSH), False),
+    "eraser_stroke": (bench_stroke(Tool.ERASER), False),
+    "spray_stroke": (bench_spray, False),
+    "selected_stroke": (bench_selected_stroke, False),
+    "save_state": (bench_save_state, False),
+    "undo_redo": (bench_undo_redo, False),
+    "composite_rebuild": (bench_composite, True),
+    "composite_frame": (bench_frame, True),
+    "composite_zoomed_out": (bench_zoomed_out, True),
+    "flatten_blended": (bench_flatten_blended, True),
+    "filter_blur": (bench_filter, False),
+    "save_drawing": (bench_save_drawing, True),
+    "save_project": (bench_save_project, True),
+    "startup": (bench_startup, False),
+}
+
+
+def make_engine(size, layers):
+    engine = DrawingEngine(*size, headless=True)
+    for i in range(layers - 1):
+        engine.add_layer()
+        # give every layer some content so blits are not trivially empty
+        center = (engine.width * (i + 1) // (layers + 1), engine.height // 2)
+        radius = engine.height // 4
+        engine.layers[-1].draw(
+            pygame.Rect(center[0] - radius, center[1] - radius, radius * 2 + 1, radius * 2 + 1),
+            lambda surface, offset: pygame.draw.circle(surface, (i * 15 % 256, 80, 160, 128),
+                                                       (center[0] + offset[0], center[1] + offset[1]), radius)
+        )
+    engine.active_layer = len(engine.layers) // 2
+    return engine
+
+
+def measure(run, repeat, min_time):
+    run()
+    samples = []
+    start = time.perf_counter()
+    while len(samples) < repeat or time.perf_counter() - start < min_time:
+        t = time.perf_counter()
+        run()
+        samples.append((time.perf_counter() - t) * 1000)
+        if len(samples) >= repeat * 10:
+            break
+    return {
+        "median_ms": statistics.median(samples),
+        "min_ms": min(samples),
+        "max_ms": max(samples),
+        "runs": len(samples),
+    }
+
+
+def run_benchmarks(sizes, layer_counts, names, repeat, min_time, log):
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="freakdraw-bench-") as workdir:
+        for size_name in sizes:
+            for name in names:
+                results.update(run_benchmark(name, size_name, layer_counts, repeat, min_time, workdir, log))
+    return results
+
+
+def run_benchmark(name, size_name, layer_counts, repeat, min_time, workdir, log):
+    results = {}
+    setup, layered = BENCHMARKS[name]
+    for layers in (layer_counts if layered else [1]):
+        key = f"{name}/{size_name}" + (f"/{layers}L" if layered else "")
+        engine = make_engine(SIZES[size_name], layers)
+        results[key] = measure(setup(engine, workdir), repeat, min_time)
+        log(f"{key:40s} {results[key]['median_ms']:10.3f} ms")
+    return results
+
+
+def compare(results, baseline, threshold):
+    # benchmarks whose median grew by more than threshold (e.g. 1.25 = 25%)
+    regressions = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        before = baseline[key]["median_ms"]
+        after = result["median_ms"]
+        ratio = after / before if before > 0 else float("inf")
+        if ratio > threshold:
+            regressions.append((key, before, after, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark FreakDraw's drawing hot paths headlessly")
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=list(SIZES))
+    parser.add_argument("--layers", nargs="+", type=int, default=LAYER_COUNTS)
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=5, help="minimum runs per benchmark")
+    parser.add_argument("--min-time", type=float, default=0.2, help="minimum seconds per benchmark")
+    parser.add_argument("-o", "--output", help="write results as JSON")
+    parser.add_argument("--baseline", help="compare against a JSON file written by --output")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="slowdown ratio that counts as a regression (default: 1.25)")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.sizes, args.layers, args.only, args.repeat, args.min_time, print)
+    report = {
+        "python": platform.python_version(),
+        "pygame": pygame.version.ver,
+        "machine": platform.machine(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for key, before, after, ratio in regressions:
+            print(f"REGRESSION {key}: {before:.3f} ms -> {after:.3f} ms ({ratio:.2f}x)")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,169 @@
+import itertools
+import os
+
+import numpy as np
+import pygame
+
+import tiles
+
+# Layer blending on NumPy arrays. Pixels are worked on as premultiplied
+# float32 RGBA; stacks of plain layers (normal mode, full opacity) skip all
+# of that and are blitted, which is exact and faster. Either way the canvas
+# is cut into tiles that are flattened on a thread pool: NumPy and SDL's
+# blitters let go of the GIL while they work, so tiles run side by side.
+
+MODES = ["normal", "multiply", "screen", "overlay", "add"]
+
+_pool = None
+
+
+def pool():
+    global _pool
+    if _pool is None:
+        # concurrent.futures is only imported once something is flattened
+        from concurrent.futures import ThreadPoolExecutor
+        _pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="blend")
+    return _pool
+
+
+def run(fn, items):
+    # [fn(item) for item in items], spread over the pool; fn must not call
+    # run itself
+    items = list(items)
+    if len(items) < 2 or (os.cpu_count() or 1) < 2:
+        return [fn(item) for item in items]
+    return list(pool().map(fn, items))
+
+
+def is_plain(layers):
+    return all(layer.blend_mode == "normal" and layer.opacity >= 1 for layer in layers)
+
+
+def surface(pixels):
+    # a Surface sharing the memory of a (height, width, 4) uint8 array laid
+    # out like a tile's pixels
+    return pygame.image.frombuffer(pixels, (pixels.shape[1], pixels.shape[0]), tiles.LAYOUT)
+
+
+def to_float(pixels):
+    rgba = pixels[..., tiles.ORDER].astype(np.float32)
+    rgba *= 1 / 255
+    rgba[..., :3] *= rgba[..., 3:]
+    return rgba
+
+
+def to_bytes(rgba, out):
+    alpha = rgba[..., 3:]
+    rgb = np.divide(rgba[..., :3], alpha, out=np.zeros_like(rgba[..., :3]), where=alpha > 0)
+    for i, channel in enumerate((rgb[..., 0], rgb[..., 1], rgb[..., 2], alpha[..., 0])):
+        out[..., tiles.ORDER[i]] = np.rint(np.clip(channel, 0, 1) * 255)
+    return out
+
+
+def read(layer, rect):
+    # the layer inside rect as premultiplied float RGBA
+    rect = pygame.Rect(rect)
+    pixels = np.zeros((rect.height, rect.width, 4), dtype=np.uint8)
+    # adding onto transparency copies pixels exactly, and unlike surfarray
+    # it does not lock tiles another thread may be blitting
+    layer.blit_to(surface(pixels), (0, 0), rect, pygame.BLEND_RGBA_ADD)
+    return to_float(pixels)
+
+
+def blend(dst, src, mode="normal", opacity=1.0):
+    # composite src over dst in place; both premultiplied float RGBA
+    if opacity < 1:
+        src = src * opacity
+    sa = src[..., 3:]
+    da = dst[..., 3:]
+    s = src[..., :3]
+    d = dst[..., :3]
+    if mode == "normal":
+        d *= 1 - sa
+        d += s
+    elif mode == "screen":
+        d += s - s * d
+    else:
+        # separable modes: s(1 - da) + d(1 - sa) + sa * da * B(d / da, s / sa)
+        if mode == "multiply":
+            mixed = s * d
+        elif mode == "add":
+            mixed = np.minimum(sa * da, s * da + d * sa)
+        elif mode == "overlay":
+            both = sa * da
+            mixed = np.where(2 * d <= da, 2 * s * d, both - 2 * (da - d) * (sa - s))
+        else:
+            raise ValueError(f"unknown blend mode {mode!r}")
+        mixed += s * (1 - da)
+        d *= 1 - sa
+        d += mixed
+    da += sa - sa * da
+    return dst
+
+
+def _flatten_into(target, pixels, pos, layers, rect, background):
+    # composite layers inside rect onto target at pos; pixels is the part of
+    # target's memory they land on, as a (height, width, 4) array
+    if background is not None:
+        background(target, pos, rect)
+    if is_plain(layers):
+        for layer in layers:
+            layer.blit_to(target, pos, rect)
+        return
+    rgba = to_float(pixels)
+    for layer in layers:
+        if layer.covers(rect):
+            blend(rgba, read(layer, rect), layer.blend_mode, layer.opacity)
+    to_bytes(rgba, pixels)
+
+
+def flatten_tile(layers, rect, background=None):
+    # layers composited inside rect as a (height, width, 4) uint8 array in
+    # tile byte order; background(surface, pos, rect) paints what is under
+    # them
+    rect = pygame.Rect(rect)
+    pixels = np.zeros((rect.height, rect.width, 4), dtype=np.uint8)
+    _flatten_into(surface(pixels), pixels, (0, 0), layers, rect, background)
+    return pixels
+
+
+def flatten(layers, rect, background=None, tile_size=tiles.TILE_SIZE, progress=None):
+    # flatten_tile over all of rect, tile by tile on the pool; the tiles all
+    # draw into the one result, which is safe as none of them overlap
+    rect = pygame.Rect(rect)
+    parts = [
+        pygame.Rect(x, y, tile_size, tile_size).clip(rect)
+        for y in range(rect.top - rect.top % tile_size, rect.bottom, tile_size)
+        for x in range(rect.left - rect.left % tile_size, rect.right, tile_size)
+    ]
+    out = np.zeros((rect.height, rect.width, 4), dtype=np.uint8)
+    target = surface(out)
+    done = itertools.count(1)
+
+    def work(part):
+        left, top = part.left - rect.left, part.top - rect.top
+        pixels = out[top:top + part.height, left:left + part.width]
+        _flatten_into(target, pixels, (left, top), layers, part, background)
+        if progress:
+            progress(next(done) / len(parts))
+
+    run(work, parts)
+    return out
+
+
+def merge(layer, above):
+    # blend above into layer's pixels in place; layer keeps its own mode
+    # and opacity
+    if is_plain([above]):
+        layer.blit_layer(above)
+        return
+
+    def work(key):
+        rect = layer.tile_rect(key)
+        rgba = read(layer, rect)
+        blend(rgba, read(above, rect), above.blend_mode, above.opacity)
+        pixels = to_bytes(rgba, np.empty((rect.height, rect.width, 4), dtype=np.uint8))
+        return rect, pixels.view(np.uint32)[..., 0].T
+
+    for rect, pixels in run(work, above.keys()):
+        layer.write(rect, pixels)
@@ -0,0 +1,175 @@
+from collections import OrderedDict
+import math
+
+import numpy as np
+import pygame
+
+
+def render_dab(radius, color, alpha, hardness, erase=False):
+    # a (2r+1)^2 stamp; hardness is the fraction of the radius at full
+    # strength, the rest falls off linearly to the edge. Erase dabs are
+    # white, with what is left of each pixel's alpha in theirs, and are
+    # applied with BLEND_RGBA_MULT so colour stays as it was.
+    size = radius * 2 + 1
+    dab = pygame.Surface((size, size), pygame.SRCALPHA)
+
+    if hardness >= 1:
+        if erase:
+            dab.fill((255, 255, 255, 255))
+            pygame.draw.circle(dab, (0, 0, 0, 0), (radius, radius), radius)
+        else:
+            pygame.draw.circle(dab, tuple(color) + (alpha,), (radius, radius), radius)
+        return dab
+
+    offsets = np.arange(size, dtype=np.float32) - radius
+    distance = np.sqrt(offsets[:, None] ** 2 + offsets[None, :] ** 2)
+    inner = radius * hardness
+    coverage = np.clip((radius - distance) / max(radius - inner, 1e-6), 0, 1)
+
+    if erase:
+        dab.fill((255, 255, 255, 0))
+        pygame.surfarray.pixels_alpha(dab)[...] = (255 - coverage * 255).astype(np.uint8)
+    else:
+        dab.fill(tuple(color) + (0,))
+        pygame.surfarray.pixels_alpha(dab)[...] = (coverage * alpha).astype(np.uint8)
+    return dab
+
+
+class DabCache:
+    def __init__(self, capacity=32):
+        self.capacity = capacity
+        self.dabs = OrderedDict()
+
+    def get(self, radius, color, alpha, hardness, erase=False):
+        key = (radius, tuple(color), alpha, hardness, erase)
+        dab = self.dabs.get(key)
+        if dab is None:
+            dab = render_dab(radius, color, alpha, hardness, erase)
+            self.dabs[key] = dab
+            if len(self.dabs) > self.capacity:
+                self.dabs.popitem(last=False)
+        else:
+            self.dabs.move_to_end(key)
+        return dab
+
+
+def dab_positions(start, end, spacing, carry=0.0):
+    # centres spaced evenly along start -> end, continuing from a stroke that
+    # already travelled carry pixels past its last dab; returns the centres
+    # and the new carry
+    length = math.hypot(end[0] - start[0], end[1] - start[1])
+    if length == 0:
+        return [], carry
+
+    distances = np.arange(spacing - carry, length + 1e-9, spacing)
+    if len(distances) == 0:
+        return [], carry + length
+
+    t = distances / length
+    xs = np.rint(start[0] + (end[0] - start[0]) * t).astype(int)
+    ys = np.rint(start[1] + (end[1] - start[1]) * t).astype(int)
+    return list(zip(xs.tolist(), ys.tolist())), length - distances[-1]
+
+
+def smooth_points(start, points, amount):
+    # exponential smoothing of a polyline that continues from start; amount
+    # in [0, 1) is how much of the previous point each new point keeps
+    smoothed = []
+    x, y = start
+    for px, py in points:
+        x += (px - x) * (1 - amount)
+        y += (py - y) * (1 - amount)
+        smoothed.append((int(round(x)), int(round(y))))
+    return smoothed
+
+
+def stamp(layer, dab, radius, centers, special_flags=0):
+    # composite every dab in one blits() call per tile and return the
+    # touched area; multiplying transparency leaves it transparent, so an
+    # erase never needs tiles that are not there yet
+    if not centers:
+        return None
+    size = radius * 2 + 1
+    lefts, tops = (np.array(centers) - radius).T
+
+    def draw(tile, offset):
+        width, height = tile.get_size()
+        xs, ys = lefts + offset[0], tops + offset[1]
+        hit = (xs < width) & (xs + size > 0) & (ys < height) & (ys + size > 0)
+        if not hit.any():
+            return None
+        rects = tile.blits(
+            [(dab, (x, y), None, special_flags) for x, y in zip(xs[hit].tolist(), ys[hit].tolist())]
+        )
+        return rects[0].unionall(rects[1:])
+
+    keys = layer.keys_under(lefts, tops, size, size)
+    return layer.draw_keys(keys, draw, create=special_flags != pygame.BLEND_RGBA_MULT)
+
+
+# each particle covers the same 2x2 block pygame.draw.circle gives radius 1
+PARTICLE_OFFSETS = np.array([(-1, -1), (0, -1), (-1, 0), (0, 0)])
+
+
+def spray(layer, centers, radius, color, alpha, count, rng):
+    # scatter count particles uniformly in angle and radius around each
+    # centre and blend them over the layer in one array pass per tile;
+    # particles landing on the same pixel are combined first, so dense
+    # sprays build up as if each had been blended in turn
+    if not centers:
+        return None
+    centers = np.repeat(np.array(centers, dtype=np.float64), count, axis=0)
+    total = len(centers)
+    angles = rng.uniform(0, 2 * np.pi, total)
+    radii = rng.uniform(0, radius, total)
+    alphas = rng.uniform(100, alpha, total)
+    xs = (centers[:, 0] + radii * np.cos(angles)).astype(int)
+    ys = (centers[:, 1] + radii * np.sin(angles)).astype(int)
+
+    width, height = layer.get_size()
+    inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    xs, ys, alphas = xs[inside], ys[inside], alphas[inside]
+    if len(xs) == 0:
+        return None
+
+    xs = (xs[:, None] + PARTICLE_OFFSETS[:, 0]).ravel()
+    ys = (ys[:, None] + PARTICLE_OFFSETS[:, 1]).ravel()
+    alphas = np.repeat(alphas.astype(int) / 255.0, len(PARTICLE_OFFSETS))
+    keep = (xs >= 0) & (ys >= 0)
+    xs, ys, alphas = xs[keep], ys[keep], alphas[keep]
+
+    # group particles by tile
+    size = layer.tile_size
+    order = np.argsort(ys // size * width + xs // size, kind="stable")
+    xs, ys, alphas = xs[order], ys[order], alphas[order]
+    cells = ys // size * width + xs // size
+    starts = np.flatnonzero(np.diff(cells, prepend=-1))
+    groups = {
+        (int(xs[start]) // size, int(ys[start]) // size): slice(start, end)
+        for start, end in zip(starts.tolist(), starts[1:].tolist() + [len(xs)])
+    }
+    src = np.array(color[:3], dtype=np.float64)
+
+    def draw(tile, offset):
+        group = groups[(-offset[0] // size, -offset[1] // size)]
+        tile_xs, tile_ys = xs[group] + offset[0], ys[group] + offset[1]
+        # what of each pixel shows through all the particles on it; they
+        # share one colour, so they act as a single particle of the rest
+        cells, inverse = np.unique(tile_xs * size + tile_ys, return_inverse=True)
+        through = np.ones(len(cells))
+        np.multiply.at(through, inverse, 1 - alphas[group])
+        tile_xs, tile_ys = np.divmod(cells, size)
+        tile_alphas = 1 - through
+        rgb = pygame.surfarray.pixels3d(tile)
+        dst_alpha = pygame.surfarray.pixels_alpha(tile)
+        below = dst_alpha[tile_xs, tile_ys] / 255.0 * (1 - tile_alphas)
+        out_alpha = tile_alphas + below
+        weight = np.divide(tile_alphas, out_alpha, out=np.zeros_like(tile_alphas), where=out_alpha > 0)[:, None]
+        rgb[tile_xs, tile_ys] = (src * weight + rgb[tile_xs, tile_ys] * (1 - weight) + 0.5).astype(np.uint8)
+        dst_alpha[tile_xs, tile_ys] = (out_alpha * 255 + 0.5).astype(np.uint8)
+        del rgb, dst_alpha
+
+        left, top = int(tile_xs.min()), int(tile_ys.min())
+        return pygame.Rect(left, top, int(tile_xs.max()) - left + 1, int(tile_ys.max()) - top + 1)
+
+    return layer.draw_keys(sorted(groups, key=lambda key: (key[1], key[0])), draw)
@@ -0,0 +1,351 @@
+import math
+import time
+
+import pygame
+
+import blend
+import tiles
+
+OUTSIDE_COLOR = (90, 90, 90)
+
+
+class Compositor:
+    def __init__(self, width, height, cell_size=20, max_rects=16, tile_size=tiles.TILE_SIZE, budget=0.008):
+        self.rect = pygame.Rect(0, 0, width, height)
+        self.max_rects = max_rects
+        self.tile_size = tile_size
+        # seconds per frame spent rebuilding mip tiles
+        self.budget = budget
+        self.cell_size = cell_size
+        self.pattern = self._render_pattern(tile_size, cell_size)
+        # per tile, everything under the active layer flattened onto the
+        # background and everything over it flattened onto transparency;
+        # only tiles that are shown at 1:1 or closer get built, and like the
+        # mips below they are dropped once the view has moved away
+        self.below = {}
+        self.above = {}
+        # mips[level][key] is the flattened document shrunk by 2 ** level and
+        # cut into tiles; stale tiles stay on screen until they are rebuilt
+        self.mips = {}
+        self.stale = {}
+        self.scratch = pygame.Surface((1, 1))
+        self.stack_key = None
+        self.view_key = None
+        self.dirty = []
+
+    def _render_pattern(self, tile_size, cell_size):
+        # enough checkerboard to cut any tile's background out of
+        size = tile_size + cell_size * 2
+        pattern = pygame.Surface((size, size))
+        pattern.fill((220, 220, 220))
+        for y in range(0, size, cell_size):
+            for x in range((y // cell_size) % 2 * cell_size, size, cell_size * 2):
+                pattern.fill((240, 240, 240), (x, y, cell_size, cell_size))
+        return pattern
+
+    def _blit_background(self, target, pos, rect):
+        period = self.cell_size * 2
+        target.blit(self.pattern, pos, (rect.x % period, rect.y % period, rect.width, rect.height))
+
+    def invalidate(self):
+        # the layer stack changed: every mip tile is out of date
+        self.stack_key = None
+        for level, cache in self.mips.items():
+            self.stale[level].update(cache)
+
+    def mark_dirty(self, rect):
+        rect = pygame.Rect(rect).clip(self.rect)
+        if rect.width and rect.height:
+            self.dirty.append(rect)
+            for level, cache in self.mips.items():
+                self.stale[level].update(key for key in self._keys(rect, level) if key in cache)
+
+    def mark_all(self):
+        self.dirty = [self.rect.copy()]
+
+    def take_dirty(self):
+        rects, self.dirty = self.dirty, []
+        if len(rects) > self.max_rects:
+            rects = [rects[0].unionall(rects[1:])]
+        return rects
+
+    def _tile_rect(self, key, level=0):
+        size = self.tile_size << level
+        return pygame.Rect(key[0] * size, key[1] * size, size, size).clip(self.rect)
+
+    def _keys(self, rect, level=0):
+        size = self.tile_size << level
+        return [
+            (tx, ty)
+            for ty in range(rect.top // size, (rect.bottom - 1) // size + 1)
+            for tx in range(rect.left // size, (rect.right - 1) // size + 1)
+        ]
+
+    def _prune(self, viewport):
+        # keep the tiles in view and a ring of tiles around it, so the caches
+        # follow the view rather than growing with everywhere it has been
+        margin = self.tile_size << viewport.level
+        near = viewport.visible_rect().inflate(margin * 2, margin * 2)
+        for cache in (self.below, self.above):
+            for key in [key for key in cache if not near.colliderect(self._tile_rect(key))]:
+                del cache[key]
+        for level, cache in self.mips.items():
+            for key in [key for key in cache if not near.colliderect(self._tile_rect(key, level))]:
+                del cache[key]
+                self.stale[level].discard(key)
+
+    def _scratch(self, size):
+        # grow-only surface for partial composites
+        width, height = self.scratch.get_size()
+        if size[0] > width or size[1] > height:
+            self.scratch = pygame.Surface((max(size[0], width), max(size[1], height)))
+        return self.scratch
+
+    def _render_below(self, layers, active, key):
+        rect = self._tile_rect(key)
+        surface = pygame.Surface(rect.size)
+        if blend.is_plain(layers[:active]):
+            self._blit_background(surface, (0, 0), rect)
+            for layer in layers[:active]:
+                layer.blit_to(surface, (0, 0), rect)
+        else:
+            surface.blit(blend.surface(blend.flatten_tile(layers[:active], rect, self._blit_background)), (0, 0))
+        return surface
+
+    def _render_above(self, layers, active, key):
+        # None when no layer above the active one has a tile here
+        rect = self._tile_rect(key)
+        above = [layer for layer in layers[active + 1:] if layer.has_tile(key)]
+        if not above:
+            return None
+        if not blend.is_plain(above):
+            return blend.surface(blend.flatten_tile(above, rect))
+        surface = pygame.Surface(rect.size, pygame.SRCALPHA)
+        for layer in above:
+            layer.blit_to(surface, (0, 0), rect)
+        return surface
+
+    def _build(self, layers, active, keys, above):
+        # fill in the per-tile caches for keys, several tiles at a time
+        missing = [key for key in keys if key not in self.below]
+        for key, surface in zip(missing, blend.run(lambda key: self._render_below(layers, active, key), missing)):
+            self.below[key] = surface
+        if above:
+            missing = [key for key in keys if key not in self.above]
+            for key, surface in zip(missing, blend.run(lambda key: self._render_above(layers, active, key), missing)):
+                self.above[key] = surface
+
+    def _compose(self, target, dest, rect, layers, active, overlay):
+        # draw the document inside rect onto target with rect's top-left at
+        # dest; overlay is an optional (surface, rect) pair whose surface
+        # holds a replacement for the active layer inside rect, from (0, 0)
+        keys = self._keys(rect)
+        # layers above the active one can only be flattened ahead of time
+        # when they all blend normally, and the active layer only blitted
+        # straight on when it is plain
+        cached_above = all(layer.blend_mode == "normal" for layer in layers[active + 1:])
+        self._build(layers, active, keys, cached_above)
+        if not (cached_above and blend.is_plain(layers[active:active + 1])):
+            self._blend_parts(target, dest, rect, layers, active, overlay, keys)
+            return
+
+        for key in keys:
+            tile_rect = self._tile_rect(key)
+            part = tile_rect.clip(rect)
+            pos = (dest[0] + part.x - rect.x, dest[1] + part.y - rect.y)
+            area = part.move(-tile_rect.x, -tile_rect.y)
+            below = self.below[key]
+            target.blit(below, pos, area)
+            layers[active].blit_to(target, pos, part)
+            if overlay is not None:
+                surface, overlay_rect = overlay
+                covered = part.clip(overlay_rect)
+                if covered.width and covered.height:
+                    # the overlay replaces the active layer there, so start
+                    # again from the cached layers below it
+                    covered_pos = (dest[0] + covered.x - rect.x, dest[1] + covered.y - rect.y)
+                    target.blit(below, covered_pos, covered.move(-tile_rect.x, -tile_rect.y))
+                    target.blit(surface, covered_pos, covered.move(-overlay_rect.x, -overlay_rect.y))
+            above = self.above[key]
+            if above is not None:
+                target.blit(above, pos, area)
+
+    def _blend_parts(self, target, dest, rect, layers, active, overlay, keys):
+        # the active layer and everything above it blended onto the cached
+        # tiles below, one part per tile on the blend pool
+        stack = list(layers[active:])
+        if overlay is not None:
+            stack[0] = Replaced(stack[0], *overlay)
+
+        def render(key):
+            tile_rect = self._tile_rect(key)
+            part = tile_rect.clip(rect)
+            below = self.below[key]
+            pixels = blend.flatten_tile(
+                stack, part, lambda surface, pos, part: surface.blit(below, pos, part.move(-tile_rect.x, -tile_rect.y))
+            )
+            return part, pixels
+
+        for part, pixels in blend.run(render, keys):
+            target.blit(blend.surface(pixels), (dest[0] + part.x - rect.x, dest[1] + part.y - rect.y))
+
+    def _flatten(self, target, rect, layers, replace=None):
+        # the whole stack inside rect onto target at (0, 0) without the
+        # per-tile caches; replace is an optional (index, overlay) pair
+        if replace is not None:
+            layers = list(layers)
+            layers[replace[0]] = Replaced(layers[replace[0]], *replace[1])
+        pixels = blend.flatten(layers, rect, self._blit_background, self.tile_size)
+        target.blit(blend.surface(pixels), (0, 0))
+
+    def _mip(self, layers, level, key, deadline):
+        # (surface, fresh) for a mip tile, rebuilding it if it is stale or
+        # missing and the frame still has time; surface is None if it was
+        # never built
+        cache = self.mips.setdefault(level, {})
+        stale = self.stale.setdefault(level, set())
+        surface = cache.get(key)
+        if surface is not None and key not in stale:
+            return surface, True
+        if time.perf_counter() > deadline:
+            return surface, False
+
+        rect = self._tile_rect(key, level)
+        size = (math.ceil(rect.width / (1 << level)), math.ceil(rect.height / (1 << level)))
+        if level == 1:
+            source = self._scratch(rect.size)
+            self._flatten(source, rect, layers)
+            source = source.subsurface((0, 0) + rect.size)
+        else:
+            children = []
+            for dy in (0, 1):
+                for dx in (0, 1):
+                    child_key = (key[0] * 2 + dx, key[1] * 2 + dy)
+                    child_rect = self._tile_rect(child_key, level - 1)
+                    if child_rect.width == 0 or child_rect.height == 0:
+                        continue
+                    child, fresh = self._mip(layers, level - 1, child_key, deadline)
+                    if not fresh:
+                        return cache.get(key), False
+                    children.append((child, (dx * self.tile_size, dy * self.tile_size)))
+            width = max(pos[0] + child.get_width() for child, pos in children)
+            height = max(pos[1] + child.get_height() for child, pos in children)
+            source = self._scratch((width, height))
+            source.blits([(child, pos) for child, pos in children], doreturn=False)
+            source = source.subsurface((0, 0, width, height))
+
+        surface = pygame.transform.smoothscale(source, size)
+        cache[key] = surface
+        stale.discard(key)
+        return surface, True
+
+    def _draw_mips(self, screen, viewport, rect, layers, active, overlay, deadline):
+        # zoomed out: mip tiles of the current level are exactly screen-sized
+        level = viewport.level
+        retry = []
+        screen.set_clip(viewport.to_screen_rect(rect).clip(viewport.window))
+        for key in self._keys(rect, level):
+            tile_rect = self._tile_rect(key, level)
+            surface, fresh = self._mip(layers, level, key, deadline)
+            pos = viewport.to_screen(tile_rect.topleft)
+            if surface is None:
+                screen.fill(OUTSIDE_COLOR, viewport.to_screen_rect(tile_rect))
+            else:
+                screen.blit(surface, pos)
+            if not fresh:
+                retry.append(tile_rect.clip(rect))
+
+        if overlay is not None:
+            area = rect.clip(overlay[1])
+            if area.width and area.height:
+                source = self._scratch(area.size)
+                self._flatten(source, area, layers, (active, overlay))
+                target = viewport.to_screen_rect(area)
+                screen.blit(pygame.transform.smoothscale(source.subsurface((0, 0) + area.size), target.size), target)
+        screen.set_clip(None)
+        return retry
+
+    def _draw_scaled(self, screen, viewport, rect, layers, active, overlay):
+        # 1:1 goes straight to the screen; zoomed in, the region is composed
+        # at document resolution and scaled up by a whole number
+        if viewport.step == 0:
+            self._compose(screen, viewport.to_screen(rect.topleft), rect, layers, active, overlay)
+            return
+        source = self._scratch(rect.size)
+        self._compose(source, (0, 0), rect, layers, active, overlay)
+        target = viewport.to_screen_rect(rect)
+        screen.blit(pygame.transform.scale(source.subsurface((0, 0) + rect.size), target.size), target)
+
+    def compose(self, screen, layers, active, viewport, overlay=None):
+        # returns the screen rects that changed
+        key = (tuple((id(layer), layer.opacity, layer.blend_mode) for layer in layers), active)
+        if key != self.stack_key:
+            self.below.clear()
+            self.above.clear()
+            self.stack_key = key
+            self.mark_all()
+
+        moved = viewport.key() != self.view_key
+        if moved:
+            self.view_key = viewport.key()
+            self._prune(viewport)
+            screen.fill(OUTSIDE_COLOR, viewport.window)
+            self.mark_all()
+
+        deadline = time.perf_counter() + self.budget
+        visible = viewport.visible_rect()
+        rects = []
+        retry = []
+        for rect in self.take_dirty():
+            rect = rect.clip(visible)
+            if rect.width == 0 or rect.height == 0:
+                continue
+            if viewport.step < 0:
+                retry.extend(self._draw_mips(screen, viewport, rect, layers, active, overlay, deadline))
+            else:
+                self._draw_scaled(screen, viewport, rect, layers, active, overlay)
+            rects.append(viewport.to_screen_rect(rect).clip(viewport.window))
+
+        # tiles that ran out of time are finished over the next frames
+        self.dirty.extend(retry)
+        if moved:
+            return [viewport.window.copy()]
+        return rects
+
+
+class Replaced:
+    # a layer whose pixels inside rect are those of surface instead, for
+    # blending a preview of the active layer; surface starts at rect's corner
+    def __init__(self, layer, surface, rect):
+        self.layer = layer
+        self.surface = surface
+        self.rect = pygame.Rect(rect)
+        self.opacity = layer.opacity
+        self.blend_mode = layer.blend_mode
+
+    def covers(self, rect):
+        return self.layer.covers(rect) or self.rect.colliderect(rect)
+
+    def blit_to(self, dest, dest_pos=(0, 0), area=None, special_flags=0):
+        area = self.layer.get_rect() if area is None else pygame.Rect(area)
+        inner = area.clip(self.rect)
+        if inner.width == 0 or inner.height == 0:
+            self.layer.blit_to(dest, dest_pos, area, special_flags)
+            return
+        # the layer around inner: full-width bands above and below it, and
+        # the pieces left and right of it
+        around = [
+            pygame.Rect(area.left, area.top, area.width, inner.top - area.top),
+            pygame.Rect(area.left, inner.bottom, area.width, area.bottom - inner.bottom),
+            pygame.Rect(area.left, inner.top, inner.left - area.left, inner.height),
+            pygame.Rect(inner.right, inner.top, area.right - inner.right, inner.height),
+        ]
+        for part in around:
+            if part.width > 0 and part.height > 0:
+                self.layer.blit_to(dest, (dest_pos[0] + part.x - area.x, dest_pos[1] + part.y - area.y), part, special_flags)
+        dest.blit(
+            self.surface,
+            (dest_pos[0] + inner.x - area.x, dest_pos[1] + inner.y - area.y),
+            inner.move(-self.rect.x, -self.rect.y),
+            special_flags
+        )
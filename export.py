@@ -0,0 +1,142 @@
+import os
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+import pygame
+
+import blend
+import tiles
+
+FORMATS = ["png", "jpg", "bmp", "tga"]
+# rows filtered and compressed per step, so no single call holds
+# the GIL for long and progress can be reported
+BAND_HEIGHT = 64
+
+
+def snapshot(layers):
+    # cheap enough for the UI thread: tiles are only copied once drawn into
+    # again, and tiles still in a project file are decoded by the worker
+    return [layer.freeze() for layer in layers]
+
+
+def _chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def write_png(path, pixels, compression=6, progress=None, order=(0, 1, 2, 3)):
+    # pixels is a (height, width, 4) array whose byte order[i] holds RGBA
+    # channel i; unlike pygame.image.save this lets the GIL go between
+    # bands, so exporting does not stall the event loop
+    height, width = pixels.shape[:2]
+    order = list(order)
+    compressor = zlib.compressobj(compression)
+    data = []
+    previous = np.zeros(width * 4, dtype=np.uint8)
+    for top in range(0, height, BAND_HEIGHT):
+        band = pixels[top:top + BAND_HEIGHT][..., order].reshape(-1, width * 4)
+        # filter type 2 (up): each row minus the one above it
+        filtered = np.empty((len(band), width * 4 + 1), dtype=np.uint8)
+        filtered[:, 0] = 2
+        filtered[0, 1:] = band[0] - previous
+        filtered[1:, 1:] = band[1:] - band[:-1]
+        previous = band[-1]
+        data.append(compressor.compress(filtered.tobytes()))
+        if progress:
+            progress(min(height, top + BAND_HEIGHT) / height)
+    data.append(compressor.flush())
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)))
+        f.write(_chunk(b"IDAT", b"".join(data)))
+        f.write(_chunk(b"IEND", b""))
+
+
+class ExportJob:
+    def __init__(self, path, size, layers, compression):
+        self.path = path
+        self.size = size
+        self.layers = layers
+        self.compression = compression
+        self.progress = 0.0
+        self.error = None
+        self.finished = None
+
+
+class Exporter:
+    # flattens and encodes snapshots on a worker thread. At most one job
+    # waits behind the running one: a save submitted before the waiting job
+    # has started replaces it, whatever its path, so repeated saves only
+    # export the latest state.
+    def __init__(self):
+        self.condition = threading.Condition()
+        # the job waiting its turn, or None
+        self.pending = None
+        self.current = None
+        self.last = None
+        self.thread = None
+
+    def submit(self, path, size, layers, compression=6):
+        job = ExportJob(path, size, layers, compression)
+        with self.condition:
+            self.pending = job
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._work, name="export", daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+        return job
+
+    def status(self, linger=3.0):
+        # (job, state) for the panel, state being "queued", "exporting",
+        # "saved" or "failed"; a finished job is reported for linger seconds
+        with self.condition:
+            if self.current is not None:
+                return self.current, "exporting"
+            if self.pending is not None:
+                return self.pending, "queued"
+            if self.last is not None and time.monotonic() - self.last.finished < linger:
+                return self.last, "failed" if self.last.error else "saved"
+        return None
+
+    def wait(self):
+        with self.condition:
+            while self.pending is not None or self.current is not None:
+                self.condition.wait()
+        return self.last
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                self.current, self.pending = self.pending, None
+            job = self.current
+            try:
+                self._export(job)
+            except Exception as e:
+                job.error = e
+            job.finished = time.monotonic()
+            with self.condition:
+                self.current = None
+                self.last = job
+                self.condition.notify_all()
+
+    def _export(self, job):
+        pixels = blend.flatten(
+            job.layers, (0, 0) + job.size, lambda surface, pos, rect: surface.fill((255, 255, 255, 255), (pos, rect.size)),
+            progress=lambda fraction: setattr(job, "progress", 0.5 * fraction)
+        )
+        job.layers = None
+
+        extension = os.path.splitext(job.path)[1].lower().lstrip(".")
+        if extension == "png":
+            write_png(
+                job.path, pixels, job.compression,
+                lambda fraction: setattr(job, "progress", 0.5 + 0.5 * fraction), tiles.ORDER
+            )
+        else:
+            pygame.image.save(blend.surface(pixels), job.path)
+        job.progress = 1.0
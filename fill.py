@@ -0,0 +1,97 @@
+import bisect
+
+import numpy as np
+import pygame
+
+
+def match_mask(layer, pixels, pos, tolerance=0):
+    # (height, width) bool array of pixels within tolerance of the colour at
+    # pos; pixels is the layer read as mapped values
+    x, y = pos
+    if tolerance <= 0:
+        return (pixels == pixels[x, y]).T
+
+    mask = None
+    for channel in layer.channels(pixels):
+        close = np.abs(channel.astype(np.int16) - int(channel[x, y])) <= tolerance
+        mask = close if mask is None else mask & close
+    return mask.T
+
+
+def _runs(mask):
+    # every horizontal run of True as (row, start, end) with end exclusive
+    height, width = mask.shape
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return rows, starts, ends
+
+
+def region_mask(mask, pos, connectivity=4):
+    # scanline fill over precomputed runs: each run is visited once and only
+    # runs in the rows directly above and below are examined
+    height, width = mask.shape
+    x, y = pos
+    if not mask[y, x]:
+        return np.zeros_like(mask)
+
+    rows, starts, ends = _runs(mask)
+    row_index = np.searchsorted(rows, np.arange(height + 1)).tolist()
+    rows, starts, ends = rows.tolist(), starts.tolist(), ends.tolist()
+    reach = 1 if connectivity == 8 else 0
+
+    seed = bisect.bisect_right(starts, x, row_index[y], row_index[y + 1]) - 1
+    visited = bytearray(len(starts))
+    visited[seed] = 1
+    stack = [seed]
+    filled = []
+
+    while stack:
+        run = stack.pop()
+        filled.append(run)
+        row, start, end = rows[run], starts[run], ends[run]
+
+        for next_row in (row - 1, row + 1):
+            if not 0 <= next_row < height:
+                continue
+            lo, hi = row_index[next_row], row_index[next_row + 1]
+            j = bisect.bisect_right(ends, start - reach, lo, hi)
+            while j < hi and starts[j] < end + reach:
+                if not visited[j]:
+                    visited[j] = 1
+                    stack.append(j)
+                j += 1
+
+    filled = np.array(filled)
+    fill_rows = np.array(rows)[filled]
+    edges = np.zeros((height, width + 1), dtype=np.int8)
+    edges[fill_rows, np.array(starts)[filled]] = 1
+    edges[fill_rows, np.array(ends)[filled]] = -1
+    return np.cumsum(edges, axis=1, dtype=np.int8)[:, :width].astype(bool)
+
+
+def flood_fill(layer, pos, color, tolerance=0, connectivity=4, bounds=None, limit=None):
+    # missing tiles read as transparent, so a fill of empty canvas only
+    # allocates the tiles the region actually reaches. The fill stays inside
+    # bounds (the whole layer by default), and inside limit, a (width,
+    # height) bool array over bounds, when given; only bounds is read.
+    bounds = layer.get_rect().clip(bounds or layer.get_rect())
+    if not bounds.collidepoint(pos):
+        return None
+    pixels = layer.read(bounds)
+    seed = (pos[0] - bounds.x, pos[1] - bounds.y)
+    mask = match_mask(layer, pixels, seed, tolerance)
+    del pixels
+    if limit is not None:
+        mask &= limit.T
+    region = region_mask(mask, seed, connectivity)
+    layer.write(bounds, layer.map_rgb(color), region.T)
+
+    rows = np.flatnonzero(region.any(axis=1))
+    cols = np.flatnonzero(region.any(axis=0))
+    if len(rows) == 0:
+        return None
+    return pygame.Rect(bounds.x + int(cols[0]), bounds.y + int(rows[0]),
+                       int(cols[-1] - cols[0]) + 1, int(rows[-1] - rows[0]) + 1)
@@ -0,0 +1,315 @@
+from enum import Enum
+import math
+import os
+
+import numpy as np
+
+# Filters run on layer pixels as premultiplied float32 RGBA, indexed [x, y]
+# like TiledLayer.read. A large job is cut into tiles, each read with a
+# margin of its neighbours' pixels so the seams match filtering the whole
+# region at once, and the tiles are farmed out to worker processes that
+# map the pixels from shared memory. The workers are spawned, so each one
+# starts by importing the script the editor was launched from, pygame and
+# all: the first job of a session waits most of a second for them, and the
+# pool is kept for the rest of it. multiprocessing is only imported once a
+# job needs the workers, so it costs the editor's start-up nothing.
+
+# edge of the tiles a job is cut into
+TILE_SIZE = 512
+# the live preview is filtered at a scale that keeps it under this many pixels
+PREVIEW_PIXELS = 512 * 384
+
+
+class Filter(Enum):
+    GAUSSIAN_BLUR = 0
+    BOX_BLUR = 1
+    SHARPEN = 2
+    BRIGHTNESS = 3
+    CONTRAST = 4
+    HUE = 5
+
+
+# default, step, minimum and maximum of each filter's amount: a radius in
+# pixels for the blurs, a strength for sharpen, an offset or gain in
+# [-1, 1] for brightness and contrast and degrees for hue
+AMOUNTS = {
+    Filter.GAUSSIAN_BLUR: (4, 1, 1, 64),
+    Filter.BOX_BLUR: (4, 1, 1, 64),
+    Filter.SHARPEN: (1.0, 0.25, 0.25, 4.0),
+    Filter.BRIGHTNESS: (0.1, 0.05, -1.0, 1.0),
+    Filter.CONTRAST: (0.2, 0.05, -1.0, 1.0),
+    Filter.HUE: (30, 15, -180, 180),
+}
+SHARPEN_RADIUS = 2
+
+
+def margin(kind, amount):
+    # how far outside a pixel the filter looks
+    if kind in (Filter.GAUSSIAN_BLUR, Filter.BOX_BLUR):
+        return int(amount)
+    if kind == Filter.SHARPEN:
+        return SHARPEN_RADIUS
+    return 0
+
+
+def to_float(pixels, shifts):
+    rgba = np.stack([(pixels >> shift) & 0xFF for shift in shifts], axis=-1).astype(np.float32)
+    rgba *= 1 / 255
+    rgba[..., :3] *= rgba[..., 3:]
+    return rgba
+
+
+def to_mapped(rgba, shifts):
+    alpha = np.clip(rgba[..., 3:], 0, 1)
+    rgb = np.divide(rgba[..., :3], alpha, out=np.zeros_like(rgba[..., :3]), where=alpha > 0)
+    channels = np.concatenate([np.clip(rgb, 0, 1), alpha], axis=-1)
+    channels = np.rint(channels * 255).astype(np.uint32)
+    return np.bitwise_or.reduce(channels << np.array(shifts, dtype=np.uint32), axis=-1)
+
+
+def _shifted(rgba, axis, radius):
+    # rgba padded with transparency by radius on both sides of axis
+    pad = [(0, 0)] * rgba.ndim
+    pad[axis] = (radius, radius)
+    return np.pad(rgba, pad)
+
+
+def _convolve(rgba, kernel, axis):
+    # kernel is symmetric, so pixels the same distance either side share a
+    # multiply
+    radius = len(kernel) // 2
+    padded = _shifted(rgba, axis, radius)
+    size = rgba.shape[axis]
+
+    def part(start):
+        index = [slice(None)] * rgba.ndim
+        index[axis] = slice(start, start + size)
+        return padded[tuple(index)]
+
+    out = part(radius) * kernel[radius]
+    scratch = np.empty_like(out)
+    for i in range(radius):
+        np.add(part(i), part(2 * radius - i), out=scratch)
+        scratch *= kernel[i]
+        out += scratch
+    return out
+
+
+def _box(rgba, radius, axis):
+    # running sums make each pass cost the same whatever the radius; in
+    # float64 they are exact for these inputs, so tiles agree at the seams
+    padded = _shifted(rgba, axis, radius + 1)
+    sums = np.cumsum(padded, axis=axis, dtype=np.float64)
+    size = rgba.shape[axis]
+    width = 2 * radius + 1
+    upper = [slice(None)] * rgba.ndim
+    upper[axis] = slice(width, width + size)
+    lower = [slice(None)] * rgba.ndim
+    lower[axis] = slice(0, size)
+    out = sums[tuple(upper)] - sums[tuple(lower)]
+    out *= 1 / width
+    return out.astype(np.float32)
+
+
+def gaussian_kernel(radius):
+    # truncated at three standard deviations
+    sigma = max(radius / 3, 0.5)
+    x = np.arange(-radius, radius + 1, dtype=np.float32)
+    kernel = np.exp(-x * x / (2 * sigma * sigma))
+    return kernel / kernel.sum()
+
+
+def gaussian_blur(rgba, radius):
+    radius = int(radius)
+    if radius < 1:
+        return rgba
+    kernel = gaussian_kernel(radius)
+    return _convolve(_convolve(rgba, kernel, 0), kernel, 1)
+
+
+def box_blur(rgba, radius):
+    radius = int(radius)
+    if radius < 1:
+        return rgba
+    return _box(_box(rgba, radius, 0), radius, 1)
+
+
+def sharpen(rgba, amount, radius=SHARPEN_RADIUS):
+    # unsharp mask, kept inside the premultiplied range
+    out = rgba + amount * (rgba - gaussian_blur(rgba, radius))
+    np.clip(out[..., 3:], 0, 1, out=out[..., 3:])
+    np.clip(out[..., :3], 0, out[..., 3:], out=out[..., :3])
+    return out
+
+
+def _adjust(rgba, fn):
+    # apply fn to straight (not premultiplied) colour
+    alpha = rgba[..., 3:]
+    rgb = np.divide(rgba[..., :3], alpha, out=np.zeros_like(rgba[..., :3]), where=alpha > 0)
+    out = rgba.copy()
+    out[..., :3] = np.clip(fn(rgb), 0, 1) * alpha
+    return out
+
+
+def brightness(rgba, amount):
+    return _adjust(rgba, lambda rgb: rgb + amount)
+
+
+def contrast(rgba, amount):
+    return _adjust(rgba, lambda rgb: (rgb - 0.5) * (1 + amount) + 0.5)
+
+
+def hue(rgba, degrees):
+    # rotation about the grey axis of the RGB cube
+    angle = math.radians(degrees)
+    c, s = math.cos(angle), math.sin(angle)
+    third = (1 - c) / 3
+    root = math.sqrt(1 / 3) * s
+    matrix = np.array([
+        [c + third, third - root, third + root],
+        [third + root, c + third, third - root],
+        [third - root, third + root, c + third],
+    ], dtype=np.float32)
+    return _adjust(rgba, lambda rgb: rgb @ matrix.T)
+
+
+def apply_array(rgba, kind, amount):
+    if kind == Filter.GAUSSIAN_BLUR:
+        return gaussian_blur(rgba, amount)
+    if kind == Filter.BOX_BLUR:
+        return box_blur(rgba, amount)
+    if kind == Filter.SHARPEN:
+        return sharpen(rgba, amount)
+    if kind == Filter.BRIGHTNESS:
+        return brightness(rgba, amount)
+    if kind == Filter.CONTRAST:
+        return contrast(rgba, amount)
+    if kind == Filter.HUE:
+        return hue(rgba, amount)
+    raise ValueError(f"unknown filter {kind!r}")
+
+
+def filter_pixels(pixels, kind, amount, shifts):
+    # mapped pixels in, mapped pixels out; pixels beyond the array count as
+    # transparent
+    return to_mapped(apply_array(to_float(pixels, shifts), kind, amount), shifts)
+
+
+_pool = None
+
+
+def workers():
+    return os.cpu_count() or 1
+
+
+def pool():
+    global _pool
+    if _pool is None:
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+        # spawned rather than forked: the parent has SDL and threads running
+        _pool = ProcessPoolExecutor(max_workers=workers(), mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def _filter_tile(source_name, target_name, shape, tile, kind, amount, shifts):
+    from multiprocessing import shared_memory
+    source = shared_memory.SharedMemory(name=source_name)
+    target = shared_memory.SharedMemory(name=target_name)
+    try:
+        pixels = np.ndarray(shape, dtype=np.uint32, buffer=source.buf)
+        out = np.ndarray(shape, dtype=np.uint32, buffer=target.buf)
+        x, y, width, height = tile
+        reach = margin(kind, amount)
+        left, top = max(0, x - reach), max(0, y - reach)
+        right, bottom = min(shape[0], x + width + reach), min(shape[1], y + height + reach)
+        result = filter_pixels(pixels[left:right, top:bottom], kind, amount, shifts)
+        out[x:x + width, y:y + height] = result[x - left:x - left + width, y - top:y - top + height]
+        del pixels, out
+    finally:
+        source.close()
+        target.close()
+
+
+def filter_tiled(pixels, kind, amount, shifts, tile_size=TILE_SIZE):
+    # filter_pixels, split into tiles across the worker processes when there
+    # is more than one tile and more than one core to give them to
+    width, height = pixels.shape
+    tiles = [
+        (x, y, min(tile_size, width - x), min(tile_size, height - y))
+        for y in range(0, height, tile_size)
+        for x in range(0, width, tile_size)
+    ]
+    if len(tiles) < 2 or workers() < 2:
+        return filter_pixels(pixels, kind, amount, shifts)
+
+    from multiprocessing import shared_memory
+    source = shared_memory.SharedMemory(create=True, size=pixels.nbytes)
+    target = shared_memory.SharedMemory(create=True, size=pixels.nbytes)
+    try:
+        shared = np.ndarray(pixels.shape, dtype=np.uint32, buffer=source.buf)
+        shared[...] = pixels
+        del shared
+        jobs = [
+            pool().submit(_filter_tile, source.name, target.name, pixels.shape, tile, kind, amount, tuple(shifts))
+            for tile in tiles
+        ]
+        for job in jobs:
+            job.result()
+        return np.ndarray(pixels.shape, dtype=np.uint32, buffer=target.buf).copy()
+    finally:
+        source.close()
+        source.unlink()
+        target.close()
+        target.unlink()
+
+
+def target_rect(layer, kind, amount, rect=None):
+    # the part of the layer a filter can change: rect, or everything painted
+    # plus however far the filter spreads it
+    if rect is None:
+        rect = layer.painted_rect().inflate(2 * margin(kind, amount), 2 * margin(kind, amount))
+    return layer.get_rect().clip(rect)
+
+
+def apply(layer, kind, amount, rect=None):
+    # filter the layer in place, inside rect if given; returns the rect
+    # that was written, or None
+    rect = target_rect(layer, kind, amount, rect)
+    if rect.width == 0 or rect.height == 0:
+        return None
+    # pixels around rect feed the filter but are not written
+    reach = margin(kind, amount)
+    source = layer.get_rect().clip(rect.inflate(2 * reach, 2 * reach))
+    pixels = filter_tiled(layer.read(source), kind, amount, layer.shifts)
+    inner = rect.move(-source.x, -source.y)
+    layer.write(rect, pixels[inner.left:inner.right, inner.top:inner.bottom])
+    return rect
+
+
+def preview(layer, kind, amount, rect, max_pixels=PREVIEW_PIXELS):
+    # (pixels, scale): the filtered layer inside rect shrunk by a whole
+    # number scale to at most max_pixels, for showing while amount changes
+    rect = layer.get_rect().clip(rect)
+    scale = max(1, math.ceil(math.sqrt(rect.width * rect.height / max_pixels)))
+    reach = margin(kind, amount)
+    # read whole blocks, with the filter's margin around rect
+    pad = -(-reach // scale) * scale
+    source = rect.inflate(2 * pad, 2 * pad)
+    source.width = -(-source.width // scale) * scale
+    source.height = -(-source.height // scale) * scale
+    pixels = np.zeros(source.size, dtype=np.uint32)
+    inside = layer.get_rect().clip(source)
+    pixels[inside.left - source.left:inside.right - source.left, inside.top - source.top:inside.bottom - source.top] = (
+        layer.read(inside)
+    )
+
+    rgba = to_float(pixels, layer.shifts)
+    if scale > 1:
+        rgba = rgba.reshape(source.width // scale, scale, source.height // scale, scale, 4).mean(axis=(1, 3))
+    small_amount = amount / scale if reach else amount
+    if kind in (Filter.GAUSSIAN_BLUR, Filter.BOX_BLUR):
+        small_amount = max(1, round(small_amount))
+    small = to_mapped(apply_array(rgba, kind, small_amount), layer.shifts)
+    offset = pad // scale
+    return small[offset:offset + -(-rect.width // scale), offset:offset + -(-rect.height // scale)], scale
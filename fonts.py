@@ -0,0 +1,52 @@
+import json
+import os
+
+import pygame
+
+# pygame.font.SysFont lists every installed font (through fc-list, the
+# registry or a directory walk) the first time it is called, which can take
+# hundreds of milliseconds. The file each name resolved to is cached on disk
+# instead, so later start-ups open it directly.
+
+CACHE_PATH = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "freakdraw", "fonts.json"
+)
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _write(path, cache):
+    # written whole and renamed into place, so a reader never sees half of it
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f"{path}.{os.getpid()}.tmp"
+        with open(partial, "w") as f:
+            json.dump(cache, f)
+        os.replace(partial, path)
+    except OSError:
+        pass
+
+
+def find(name, cache_path=CACHE_PATH):
+    # the font file for name, or None for pygame's default font; a cached
+    # file that has since been removed is looked up again
+    cache = _read(cache_path)
+    if name in cache and (cache[name] is None or os.path.exists(cache[name])):
+        return cache[name]
+    path = pygame.font.match_font(name)
+    cache[name] = path
+    _write(cache_path, cache)
+    return path
+
+
+def load(name, size, cache_path=CACHE_PATH):
+    # what pygame.font.SysFont(name, size) gives, without the font scan once
+    # name has been looked up before
+    return pygame.font.Font(find(name, cache_path), size)
@@ -0,0 +1,214 @@
+import time
+import weakref
+import zlib
+
+import numpy as np
+import pygame
+
+import tiles
+
+# Undo history as a journal of the commands that changed the document
+# (strokes as point lists, shape corners, fill seeds, layer operations, ...)
+# plus keyframes of the whole layer stack every so often. Undoing restores
+# the newest keyframe before the undone command and replays the commands
+# between the two. Keyframes share tiles copy-on-write with the layers, so
+# one only costs memory for the tiles drawn into after it was taken, and
+# once a newer keyframe no longer shares a tile it is kept compressed, as a
+# source the layer decodes when the tile is next used, like a project's.
+
+# a keyframe is taken once replaying the commands since the last one would
+# take this long, in seconds, so undo fits in a frame
+KEYFRAME_COST = 0.012
+# or after this many commands, whatever they cost
+KEYFRAME_INTERVAL = 64
+
+
+class Command:
+    def __init__(self, command, settings, cost):
+        # command is a dict in the format replay.py reads; settings are the
+        # engine settings it ran with and cost how long it took, in seconds
+        self.command = command
+        self.settings = settings
+        self.cost = cost
+        # once undone, the keyframe taken right after it, if there was one,
+        # so redo can restore it instead of carrying the command out again
+        self.keyframe = None
+
+
+class Chunk:
+    # one compressed tile, read back like a tile of a project file
+    def __init__(self, pixels, compression):
+        self.data = zlib.compress(pixels.tobytes(), compression)
+
+    def read_tile(self, offset, length, size):
+        pixels = np.frombuffer(zlib.decompress(self.data), dtype=np.uint32).reshape(size)
+        tile = pygame.Surface(size, pygame.SRCALPHA)
+        pygame.surfarray.pixels2d(tile)[...] = pixels
+        return tile
+
+    def chunk(self, offset, length):
+        return self.data
+
+
+class Keyframe:
+    def __init__(self, index, layers, active_layer):
+        # the layer stack after the first index commands of the journal
+        self.index = index
+        self.layers = [(layer, layer.freeze()) for layer in layers]
+        self.active_layer = active_layer
+
+    def frozen(self):
+        return {id(layer): frozen for layer, frozen in self.layers}
+
+    def restore(self):
+        # put every layer back as it was; returns the layers and the rects
+        # whose pixels may have changed
+        rects = []
+        for layer, frozen in self.layers:
+            changed = [
+                key for key in set(layer.keys()) | set(frozen.keys())
+                if layer.tiles.get(key) is not frozen.tiles.get(key)
+                or layer.sources.get(key) != frozen.sources.get(key)
+            ]
+            layer.tiles = dict(frozen.tiles)
+            layer.sources = dict(frozen.sources)
+            layer.shared = set(frozen.tiles)
+            layer.opacity = frozen.opacity
+            layer.blend_mode = frozen.blend_mode
+            layer.changed(changed)
+            rects.extend(layer.tile_rect(key) for key in changed)
+        return [layer for layer, _ in self.layers], rects
+
+
+class History:
+    def __init__(self, budget=64 * 1024 * 1024, compression=1, keyframe_cost=KEYFRAME_COST,
+                 keyframe_interval=KEYFRAME_INTERVAL):
+        self.budget = budget
+        self.compression = compression
+        self.keyframe_cost = keyframe_cost
+        self.keyframe_interval = keyframe_interval
+        # commands since the oldest keyframe, and those undone since
+        self.done = []
+        self.undone = []
+        # oldest first; the oldest is at index 0
+        self.keyframes = []
+        # bytes of compressed tiles the keyframes hold
+        self.used = 0
+        # the action begun but not yet committed: its settings, when it
+        # started, time spent drawing it so far and whether it changed anything
+        self.pending = None
+        self.started = 0.0
+        self.spent = 0.0
+        self.touched = False
+
+    def begin(self, settings, layers, active_layer):
+        if not self.keyframes:
+            self.keyframes.append(Keyframe(0, layers, active_layer))
+        self.pending = settings
+        self.started = time.perf_counter()
+        self.spent = 0.0
+        self.touched = False
+
+    def touch(self):
+        if self.pending is not None:
+            self.touched = True
+
+    def spend(self, seconds):
+        # time spent on the pending action while it runs in pieces, like a
+        # stroke drawn over many frames; otherwise it is timed from begin
+        self.spent += seconds
+
+    def commit(self, command, layers, active_layer):
+        # journal the pending action as command, if it changed anything
+        settings, touched = self.pending, self.touched
+        self.pending = None
+        self.touched = False
+        if settings is None or command is None or not touched:
+            return None
+        cost = self.spent or time.perf_counter() - self.started
+        entry = Command(command, settings, cost)
+        self.undone.clear()
+        self.push(entry, layers, active_layer)
+        return entry
+
+    def push(self, entry, layers, active_layer):
+        # entry has just been carried out on layers
+        self.done.append(entry)
+        newest = self.keyframes[-1]
+        since = self.done[newest.index:]
+        if sum(command.cost for command in since) >= self.keyframe_cost or len(since) >= self.keyframe_interval:
+            keyframe = Keyframe(len(self.done), layers, active_layer)
+            self._compress(newest, keyframe)
+            self.keyframes.append(keyframe)
+            self._evict()
+
+    def undo(self):
+        # (keyframe, commands to replay after restoring it, the undone
+        # command), or None when there is nothing left to undo
+        self.pending = None
+        if not self.done:
+            return None
+        entry = self.done.pop()
+        self.undone.append(entry)
+        while self.keyframes[-1].index > len(self.done):
+            entry.keyframe = self.keyframes.pop()
+        newest = self.keyframes[-1]
+        return newest, self.done[newest.index:], entry
+
+    def redo(self):
+        # the command to redo: restore its keyframe and call redone(), or
+        # when it has none carry it out again and push it back
+        self.pending = None
+        if not self.undone:
+            return None
+        return self.undone.pop()
+
+    def redone(self, entry):
+        # entry is in effect again from the keyframe undo kept for it
+        keyframe, entry.keyframe = entry.keyframe, None
+        self.done.append(entry)
+        keyframe.index = len(self.done)
+        self.keyframes.append(keyframe)
+
+    def _compress(self, keyframe, newer):
+        # keyframe is no longer the newest: compress the tiles newer does not
+        # share, in it and in the older keyframes that share them with it.
+        # Older keyframes only hold tiles uncompressed that keyframe holds
+        # too, so nothing is left uncompressed but what newer shares.
+        kept = newer.frozen()
+        older = [kf.frozen() for kf in reversed(self.keyframes[:-1])]
+        for layer, frozen in keyframe.layers:
+            shared = kept.get(id(layer))
+            for key, tile in list(frozen.tiles.items()):
+                newer_tile = None if shared is None else shared.tiles.get(key)
+                if newer_tile is tile:
+                    continue
+                pixels = tiles.tile_pixels(tile)
+                source = None
+                if newer_tile is None or not np.array_equal(pixels, tiles.tile_pixels(newer_tile)):
+                    chunk = Chunk(pixels, self.compression)
+                    self.used += len(chunk.data)
+                    weakref.finalize(chunk, self._free, len(chunk.data))
+                    source = (chunk, 0, len(chunk.data))
+                for copy in [frozen] + [layers.get(id(layer)) for layers in older]:
+                    if copy is None or copy.tiles.get(key) is not tile:
+                        break
+                    if source is None:
+                        # copied to be drawn into but left the same: share newer's
+                        copy.tiles[key] = newer_tile
+                    else:
+                        del copy.tiles[key]
+                        copy.sources[key] = source
+
+    def _free(self, size):
+        self.used -= size
+
+    def _evict(self):
+        # forget the oldest keyframes, and the commands only they can be
+        # replayed from, until the rest fit the budget
+        while self.used > self.budget and len(self.keyframes) > 1:
+            self.keyframes.pop(0)
+            drop = self.keyframes[0].index
+            del self.done[:drop]
+            for keyframe in self.keyframes:
+                keyframe.index -= drop
@@ -1,8 +1,32 @@
+import time
+
+# start-up is timed from here to the first frame on screen
+STARTED = time.perf_counter()
+
 import pygame
-import pygame.gfxdraw
 import numpy as np
 from enum import Enum
+import argparse
+import json
 import math
+import os
+import random
+
+import fill
+import fonts
+import gradient
+import history
+import compositor
+import blend
+import brushes
+import export
+import filters
+import profiler
+import project
+import selection
+import tiles
+import ui
+import viewport
 
 class Tool(Enum):
     PENCIL = 0
@@ -15,25 +39,54 @@ class Tool(Enum):
     SPRAY = 7
     ERASER = 8
     GRADIENT = 9
+    SELECT_RECT = 10
+    SELECT_ELLIPSE = 11
+    MAGIC_WAND = 12
+
+SELECT_TOOLS = [Tool.SELECT_RECT, Tool.SELECT_ELLIPSE, Tool.MAGIC_WAND]
+# how far each press of J feathers the selection, in pixels
+FEATHER_STEP = 4
+# shortcuts that write files (export, save the project, export a trace);
+# they are left out of recorded sessions so replaying one does not write them
+FILE_KEYS = {pygame.K_s, pygame.K_p, pygame.K_F4}
+
+# engine settings a journaled command runs with; undo replays commands with
+# the settings they were first carried out with
+ACTION_SETTINGS = [
+    "current_tool", "brush_size", "color", "fill_color", "alpha", "gradient_start", "gradient_end",
+    "gradient_mode", "brush_hardness", "brush_spacing", "spray_density", "stroke_smoothing",
+    "fill_tolerance", "fill_connectivity", "selection", "active_layer",
+]
+
+def point(value):
+    return (int(value[0]), int(value[1]))
 
 class DrawingEngine:
-    def __init__(self, width=800, height=600):
-        pygame.init()
+    def __init__(self, width=800, height=600, headless=False, window_size=None):
+        # width and height are the document's; the window defaults to the same size
+        if headless:
+            os.environ["SDL_VIDEODRIVER"] = "dummy"
+        # when setup began, for the start-up report; setup_finished is set last
+        self.setup_started = time.perf_counter()
+        # only what drawing needs: pygame.init() would start audio as well
+        pygame.display.init()
+        pygame.font.init()
         self.width = width
         self.height = height
-        self.screen = pygame.display.set_mode((width, height))
+        self.window_width, self.window_height = window_size or (width, height)
+        self.screen = pygame.display.set_mode((self.window_width, self.window_height))
         pygame.display.set_caption("FreakDraw 2")
 
-        self.canvas = pygame.Surface((width, height))
-        self.canvas.fill((255, 255, 255))
-
-        self.layers = [pygame.Surface((width, height), pygame.SRCALPHA)]
+        self.layers = [tiles.TiledLayer(width, height)]
         self.active_layer = 0
         
-        self.ui_font = pygame.font.SysFont('Arial', 16)
         self.ui_color = (50, 50, 50)
         self.ui_panel_height = 60
-        self.ui_panel = pygame.Surface((width, self.ui_panel_height))
+        self.ui_panel = pygame.Surface((self.window_width, self.ui_panel_height))
+        self.ui_panel_rect = self.ui_panel.get_rect(bottomleft=(0, self.window_height))
+        # what the panel was last rendered from; it is only redrawn when this changes
+        self.ui_state = None
+        self.text_cache = ui.TextCache()
         
         self.current_tool = Tool.PENCIL
         self.brush_size = 5
@@ -42,285 +95,799 @@ class DrawingEngine:
         self.alpha = 255
         self.gradient_start = (255, 0, 0)
         self.gradient_end = (0, 0, 255)
+        self.gradient_mode = gradient.GradientMode.LINEAR
+        self.brush_hardness = 1.0
+        self.brush_spacing = 0.25
+        self.dabs = brushes.DabCache()
+        self.dab_carry = 0
+        self.spray_density = 2
+        self.stroke_smoothing = 0
+        self.stroke_points = []
+        self.stroke_segments = []
+        self.recorder = None
+        self.seed_spray()
+        self.fill_tolerance = 0
+        self.fill_connectivity = 4
+        # edits only land inside the selection when there is one; dragging
+        # out a new one adds to it with Shift and intersects it with Ctrl
+        self.selection = None
+        self.selection_mode = "replace"
+        # the outline as last drawn: (surface, screen rect) and what it was
+        # drawn from
+        self.selection_outline = None
+        self.selection_outline_key = None
 
         self.start_pos = None
         self.drawing = False
         self.last_pos = None
-        self.undo_stack = []
-        self.redo_stack = []
+        self.history = history.History()
+        # set while undo replays journaled commands, which must not be
+        # journaled again
+        self.replaying = False
+        self.compositor = compositor.Compositor(width, height)
+        self.viewport = viewport.Viewport((self.window_width, self.window_height), (width, height))
+        self.panning = False
+        self.project_path = None
+        self.exporter = export.Exporter()
+        self.export_format = "png"
+        self.export_compression = 6
+        # filter being previewed on the active layer (None when off) and the
+        # amount each filter was last set to
+        self.filter = None
+        self.filter_amounts = {kind: amounts[0] for kind, amounts in filters.AMOUNTS.items()}
+        # the preview as an overlay (surface, document rect), and what it
+        # was computed from
+        self.filter_preview = None
+        self.filter_preview_key = None
         
 
         self.text_input = ""
         self.font_size = 24
-        self.font = pygame.font.SysFont('Arial', self.font_size)
+        # fonts by size, opened when first drawn with
+        self.open_fonts = {}
         
+        self.overlay_rects = []
+        self.preview_surface = pygame.Surface((1, 1), pygame.SRCALPHA)
+        self.profiler = profiler.Profiler()
+        self.show_profiler = False
+        self.profiler_rect = pygame.Rect(0, 0, min(self.window_width, 560), 46)
         self.clock = pygame.time.Clock()
         self.running = True
+        # TEXT tool preview as last drawn: (text, colour, document rect, view)
+        # and its screen rect
+        self.text_preview = None
+        self.text_preview_rect = None
+        # quit as soon as the first frame is on screen, to time start-up
+        self.startup_only = False
+        self.setup_finished = time.perf_counter()
+    
+    def get_font(self, size):
+        font = self.open_fonts.get(size)
+        if font is None:
+            font = self.open_fonts[size] = fonts.load("Arial", size)
+        return font
+    
+    @property
+    def ui_font(self):
+        return self.get_font(16)
     
+    @property
+    def font(self):
+        # the TEXT tool's
+        return self.get_font(self.font_size)
+    
+    @profiler.timed
     def save_state(self):
-        layer_copy = self.layers[self.active_layer].copy()
-        self.undo_stack.append(layer_copy)
-        self.redo_stack = []
+        # begin an undoable action
+        if not self.replaying:
+            self.stroke_segments = []
+            self.history.begin(self.settings(), self.layers, self.active_layer)
+    
+    @profiler.timed
+    def commit_state(self, op=None, **fields):
+        # end the action begun by save_state, journaled as the command op
+        # (a stroke when None) if it changed anything
+        if self.replaying:
+            return
+        command = None
+        if op is not None:
+            command = {"op": op, **fields}
+        elif self.stroke_segments:
+            command = {"op": "stroke", "segments": self.stroke_segments}
+        self.stroke_segments = []
+        self.history.commit(command, self.layers, self.active_layer)
     
+    def settings(self):
+        settings = {name: getattr(self, name) for name in ACTION_SETTINGS}
+        if self.current_tool == Tool.SPRAY:
+            settings["spray_state"] = self.spray_rng.bit_generator.state
+        return settings
+    
+    def apply_settings(self, settings):
+        for name, value in settings.items():
+            if name == "spray_state":
+                self.spray_rng.bit_generator.state = value
+            else:
+                setattr(self, name, value)
+    
+    def replay_commands(self, commands):
+        # carry out journaled commands again, each with its own settings;
+        # the settings in use now are put back afterwards, apart from the
+        # active layer, which is left where the commands put it
+        current = self.settings()
+        if self._spray_rng is not None:
+            current["spray_state"] = self.spray_rng.bit_generator.state
+        del current["active_layer"]
+        text_input = self.text_input
+        self.replaying = True
+        try:
+            for entry in commands:
+                self.apply_settings(entry.settings)
+                self.perform(entry.command)
+        finally:
+            self.replaying = False
+            self.apply_settings(current)
+            if "spray_state" not in current:
+                # not sprayed with before: start from its seed again
+                self._spray_rng = None
+            self.text_input = text_input
+    
+    @profiler.timed
     def undo(self):
-        if len(self.undo_stack) > 0:
-            self.redo_stack.append(self.layers[self.active_layer].copy())
-            self.layers[self.active_layer] = self.undo_stack.pop()
+        # restore the newest keyframe before the last command and replay
+        # the ones in between; not while a stroke is still being drawn, as
+        # the rest of it would not be journaled
+        if self.drawing:
+            return
+        self.commit_state()
+        step = self.history.undo()
+        if step is None:
+            return
+        keyframe, commands, undone = step
+        self.layers, rects = keyframe.restore()
+        for rect in rects:
+            self.compositor.mark_dirty(rect)
+        self.replay_commands(commands)
+        self.active_layer = min(undone.settings["active_layer"], len(self.layers) - 1)
     
+    @profiler.timed
     def redo(self):
-        if len(self.redo_stack) > 0:
-            self.undo_stack.append(self.layers[self.active_layer].copy())
-            self.layers[self.active_layer] = self.redo_stack.pop()
+        if self.drawing:
+            return
+        self.commit_state()
+        entry = self.history.redo()
+        if entry is None:
+            return
+        if entry.keyframe is not None:
+            # the state right after it was kept when it was undone
+            self.layers, rects = entry.keyframe.restore()
+            for rect in rects:
+                self.compositor.mark_dirty(rect)
+            self.active_layer = entry.keyframe.active_layer
+            self.history.redone(entry)
+            return
+        started = time.perf_counter()
+        self.replay_commands([entry])
+        entry.cost = time.perf_counter() - started
+        self.history.push(entry, self.layers, self.active_layer)
+    
+    def perform(self, command):
+        # carry out a command as one undoable action with the current
+        # settings; commands are dicts in the format replay.py reads
+        op = command["op"]
+        if op == "stroke":
+            self.save_state()
+            self.last_pos = None
+            for segment in command["segments"]:
+                if segment:
+                    self.draw_stroke([point(p) for p in segment])
+            self.last_pos = None
+            self.commit_state()
+        elif op == "shape":
+            self.start_shape(point(command["start"]))
+            self.finish_shape(point(command["end"]))
+        elif op == "fill":
+            self.flood_fill(point(command["pos"]))
+        elif op == "text":
+            self.text_input = command["text"]
+            self.save_state()
+            self.place_text(point(command["pos"]))
+        elif op == "filter":
+            self.apply_filter(filters.Filter[command["kind"]], command["amount"])
+        elif op == "add_layer":
+            self.add_layer()
+        elif op == "remove_layer":
+            self.remove_layer()
+        elif op == "merge_down":
+            self.merge_down()
+        elif op == "opacity":
+            self.set_opacity(command["value"])
+        elif op == "blend_mode":
+            self.set_blend_mode(command["value"])
+        else:
+            raise ValueError(f"unknown op {op!r}")
+    
+    def mark_dirty(self, rect):
+        self.compositor.mark_dirty(rect)
+        self.history.touch()
+    
+    def edit(self, draw):
+        # draw() changes the active layer and returns the rect it changed;
+        # with a selection, whatever it changed outside the mask is put back
+        # from a copy-on-write freeze, so only the tiles drawn into are copied
+        layer = self.layers[self.active_layer]
+        if self.selection is None:
+            rect = draw()
+        else:
+            before = layer.freeze()
+            rect = draw()
+            if rect:
+                rect = self.selection.keep(layer, before, rect)
+        if rect:
+            self.mark_dirty(rect)
+        return rect
+    
+    def selected_bounds(self, bounds):
+        # the part of bounds a tool needs to work on
+        if self.selection is None:
+            return bounds
+        return pygame.Rect(bounds).clip(self.selection.rect)
+    
+    def selected_centers(self, centers, radius):
+        # the dab centres whose dabs reach the selection
+        if self.selection is None or not centers:
+            return centers
+        reach = self.selection.rect.inflate(radius * 2, radius * 2)
+        return [center for center in centers if reach.collidepoint(center)]
+    
+    def select(self, shape, start, end=None, mode="replace"):
+        # shape is "rect" or "ellipse", dragged from start to end, or "wand"
+        # for the region a fill at start would cover; mode is "replace",
+        # "union" or "intersect"
+        size = (self.width, self.height)
+        start = point(start)
+        if shape == "wand":
+            if not self.layers[self.active_layer].get_rect().collidepoint(start):
+                return
+            chosen = selection.magic_wand(self.layers[self.active_layer], start, self.fill_tolerance, self.fill_connectivity)
+        elif shape == "ellipse":
+            chosen = selection.ellipse(size, self.get_rect_from_points(start, point(end)))
+        else:
+            chosen = selection.rectangle(size, self.get_rect_from_points(start, point(end)))
+        if self.selection is not None and mode == "union":
+            chosen = self.selection.union(chosen)
+        elif self.selection is not None and mode == "intersect":
+            chosen = self.selection.intersect(chosen)
+        self.set_selection(chosen)
+    
+    def set_selection(self, chosen):
+        # an empty selection selects nothing, which is no selection at all
+        if chosen is not None and chosen.empty():
+            chosen = None
+        for old in (self.selection, chosen):
+            if old is not None:
+                self.compositor.mark_dirty(old.rect.inflate(2, 2))
+        self.selection = chosen
+    
+    def invert_selection(self):
+        if self.selection is None:
+            self.set_selection(selection.rectangle((self.width, self.height), (0, 0, self.width, self.height)))
+        else:
+            self.set_selection(self.selection.invert())
+    
+    def feather_selection(self, radius=FEATHER_STEP):
+        if self.selection is not None:
+            self.set_selection(self.selection.feather(radius))
+    
+    @profiler.timed
+    def draw_selection_outline(self, dirty_rects):
+        # the outline is drawn over the composited frame, again whenever
+        # something was composited under it; returns the screen rect drawn
+        key = None
+        if self.selection is not None:
+            key = (self.selection, self.viewport.key())
+        if key != self.selection_outline_key:
+            self.selection_outline_key = key
+            self.selection_outline = None if key is None else self.selection.outline(self.viewport)
+            if self.selection_outline:
+                dirty_rects = [self.selection_outline[1]]
+        if self.selection_outline is None:
+            return None
+        surface, rect = self.selection_outline
+        if rect.collidelist(dirty_rects) == -1:
+            return None
+        return self.screen.blit(surface, rect)
     
     def add_layer(self):
-        new_layer = pygame.Surface((self.width, self.height), pygame.SRCALPHA)
+        self.save_state()
+        new_layer = tiles.TiledLayer(self.width, self.height)
         self.layers.append(new_layer)
         self.active_layer = len(self.layers) - 1
+        self.compositor.invalidate()
+        self.history.touch()
+        self.commit_state("add_layer")
+    
+    def set_opacity(self, opacity):
+        self.save_state()
+        self.layers[self.active_layer].opacity = opacity
+        self.compositor.invalidate()
+        self.history.touch()
+        self.commit_state("opacity", value=opacity)
+    
+    def set_blend_mode(self, mode):
+        self.save_state()
+        self.layers[self.active_layer].blend_mode = mode
+        self.compositor.invalidate()
+        self.history.touch()
+        self.commit_state("blend_mode", value=mode)
+    
+    def cycle_opacity(self):
+        layer = self.layers[self.active_layer]
+        opacities = [1.0, 0.75, 0.5, 0.25]
+        current_idx = opacities.index(layer.opacity) if layer.opacity in opacities else 0
+        self.set_opacity(opacities[(current_idx + 1) % len(opacities)])
+    
+    def cycle_blend_mode(self):
+        layer = self.layers[self.active_layer]
+        self.set_blend_mode(blend.MODES[(blend.MODES.index(layer.blend_mode) + 1) % len(blend.MODES)])
+    
+    def cycle_filter(self):
+        # off, then each filter in turn, then off again
+        kinds = [None] + list(filters.Filter)
+        self.filter = kinds[(kinds.index(self.filter) + 1) % len(kinds)]
+    
+    def adjust_filter(self, steps):
+        _, step, low, high = filters.AMOUNTS[self.filter]
+        amount = self.filter_amounts[self.filter] + steps * step
+        self.filter_amounts[self.filter] = min(high, max(low, round(amount, 6)))
+    
+    @profiler.timed
+    def apply_filter(self, kind, amount):
+        # filter the whole active layer (and however far the filter spreads
+        # it), or the selection, on the filter process pool
+        self.save_state()
+        rect = None if self.selection is None else self.selection.rect
+        self.edit(lambda: filters.apply(self.layers[self.active_layer], kind, amount, rect))
+        self.commit_state("filter", kind=kind.name, amount=amount)
+    
+    def handle_filter_key(self, key):
+        # keys that drive a filter being previewed; True when key was one
+        if self.filter is None:
+            return False
+        if key == pygame.K_PERIOD:
+            self.adjust_filter(1)
+        elif key == pygame.K_COMMA:
+            self.adjust_filter(-1)
+        elif key in (pygame.K_RETURN, pygame.K_KP_ENTER):
+            self.apply_filter(self.filter, self.filter_amounts[self.filter])
+            self.filter = None
+        elif key == pygame.K_ESCAPE:
+            self.filter = None
+        else:
+            return False
+        return True
+    
+    def filter_preview_rect(self):
+        # what the preview covers: the part of the filtered area in view, at
+        # most a window's worth of document pixels around the view's centre
+        layer = self.layers[self.active_layer]
+        visible = self.viewport.visible_rect()
+        rect = filters.target_rect(layer, self.filter, self.filter_amounts[self.filter]).clip(visible)
+        rect = self.selected_bounds(rect)
+        around = pygame.Rect(0, 0, self.window_width, self.window_height)
+        around.center = visible.center
+        return rect.clip(around)
+    
+    @profiler.timed
+    def update_filter_preview(self):
+        # recompute the preview overlay when the filter, its amount, the
+        # layer or the view changed; returns the overlay. Drawing turns the
+        # filter off, so undo and redo are the only other edits to look for
+        key = None
+        if self.filter is not None:
+            key = (self.filter, self.filter_amounts[self.filter], self.active_layer,
+                   id(self.layers[self.active_layer]), self.viewport.key(), self.selection,
+                   len(self.history.done), len(self.history.undone))
+        if key == self.filter_preview_key:
+            return self.filter_preview
+        self.filter_preview_key = key
+        if self.filter_preview:
+            self.mark_dirty(self.filter_preview[1])
+        self.filter_preview = None
+        if key is None:
+            return None
+        
+        rect = self.filter_preview_rect()
+        if rect.width == 0 or rect.height == 0:
+            return None
+        pixels, scale = filters.preview(self.layers[self.active_layer], self.filter, self.filter_amounts[self.filter], rect)
+        small = pygame.Surface(pixels.shape, pygame.SRCALPHA)
+        pygame.surfarray.pixels2d(small)[...] = pixels
+        surface = pygame.transform.scale(small, (pixels.shape[0] * scale, pixels.shape[1] * scale))
+        self.filter_preview = self.confine_preview((surface, rect))
+        self.mark_dirty(rect)
+        return self.filter_preview
+    
+    def confine_preview(self, preview):
+        # a preview (surface, document rect) of the active layer as the edit
+        # would leave it under the selection
+        if self.selection is None:
+            return preview
+        surface, rect = preview
+        inner = rect.clip(self.selection.rect)
+        if inner.width == 0 or inner.height == 0:
+            return None
+        surface = surface.subsurface(inner.move(-rect.x, -rect.y))
+        cover = self.selection.coverage(inner)
+        outside = cover < selection.FULL
+        if outside.any():
+            layer = self.layers[self.active_layer]
+            pixels = pygame.surfarray.pixels2d(surface)
+            pixels[outside] = selection.mix(layer.read(inner)[outside], pixels[outside], cover[outside], layer.shifts)
+            del pixels
+        return surface, inner
     
     def remove_layer(self):
         if len(self.layers) > 1:
+            self.save_state()
             self.layers.pop(self.active_layer)
             self.active_layer = min(self.active_layer, len(self.layers) - 1)
+            self.compositor.invalidate()
+            self.history.touch()
+            self.commit_state("remove_layer")
     
     def merge_down(self):
         if self.active_layer > 0:
-            self.layers[self.active_layer - 1].blit(self.layers[self.active_layer], (0, 0))
+            self.save_state()
+            blend.merge(self.layers[self.active_layer - 1], self.layers[self.active_layer])
             self.layers.pop(self.active_layer)
             self.active_layer -= 1
+            self.compositor.invalidate()
+            self.history.touch()
+            self.commit_state("merge_down")
     
-    def draw_ui(self):
+    @profiler.timed
+    def draw_ui(self, covered=()):
+        # returns the panel's screen rect when it was drawn: when its state
+        # changed, or when something in covered was drawn over it; else None
+        export_text = self.export_status()
+        layer = self.layers[self.active_layer]
+        filter_amount = None if self.filter is None else self.filter_amounts[self.filter]
+        selected = None if self.selection is None else self.selection.rect.size
+        state = (self.current_tool, self.brush_size, self.color, self.active_layer, len(self.layers),
+                 layer.blend_mode, layer.opacity, self.viewport.zoom, export_text, self.filter, filter_amount, selected)
+        if state == self.ui_state:
+            if self.ui_panel_rect.collidelist(covered) == -1:
+                return None
+            return self.screen.blit(self.ui_panel, self.ui_panel_rect)
+        self.ui_state = state
         self.ui_panel.fill((220, 220, 220))
         
 
         tool_text = f"Tool: {self.current_tool.name} | Size: {self.brush_size} | Color: RGB{self.color}"
-        tool_surf = self.ui_font.render(tool_text, True, self.ui_color)
+        if self.filter is not None:
+            tool_text = f"Filter: {self.filter.name} {filter_amount:g} | ,/.=Amount, Enter=Apply, Esc=Cancel"
+        tool_surf = self.text_cache.render(self.ui_font, tool_text, self.ui_color)
         self.ui_panel.blit(tool_surf, (10, 10))
         
-        layer_text = f"Layer: {self.active_layer + 1}/{len(self.layers)}"
-        layer_surf = self.ui_font.render(layer_text, True, self.ui_color)
+        layer_text = (f"Layer: {self.active_layer + 1}/{len(self.layers)} {layer.blend_mode} {layer.opacity * 100:g}%"
+                      f" | Zoom: {self.viewport.zoom * 100:g}%")
+        if selected:
+            layer_text += f" | Selection: {selected[0]}x{selected[1]}"
+        layer_surf = self.text_cache.render(self.ui_font, layer_text, self.ui_color)
         self.ui_panel.blit(layer_surf, (10, 30))
         
 
         help_text = "Keys: 1-9=Tools, +/-=Size, U=Undo, R=Redo, L=New Layer, D=Delete Layer, M=Merge Down"
-        help_surf = self.ui_font.render(help_text, True, self.ui_color)
-        self.ui_panel.blit(help_surf, (self.width // 2 - help_surf.get_width() // 2, 30))
+        help_surf = self.text_cache.render(self.ui_font, help_text, self.ui_color)
+        self.ui_panel.blit(help_surf, (self.window_width - 50 - help_surf.get_width(), 30))
+
+        export_surf = self.text_cache.render(self.ui_font, export_text, self.ui_color)
+        self.ui_panel.blit(export_surf, (self.window_width - 50 - export_surf.get_width(), 10))
 
-        pygame.draw.rect(self.ui_panel, self.color, (self.width - 40, 10, 30, 30))
-        pygame.draw.rect(self.ui_panel, (0, 0, 0), (self.width - 40, 10, 30, 30), 1)
+        pygame.draw.rect(self.ui_panel, self.color, (self.window_width - 40, 10, 30, 30))
+        pygame.draw.rect(self.ui_panel, (0, 0, 0), (self.window_width - 40, 10, 30, 30), 1)
         
-        self.screen.blit(self.ui_panel, (0, self.height - self.ui_panel_height))
+        return self.screen.blit(self.ui_panel, self.ui_panel_rect)
     
-    def draw_pencil(self, pos):
-        if self.last_pos:
-            pygame.draw.line(
-                self.layers[self.active_layer],
-                self.color + (self.alpha,),
-                self.last_pos,
-                pos,
-                max(1, self.brush_size // 3)
-            )
-        else:
-            pygame.draw.circle(
-                self.layers[self.active_layer],
-                self.color + (self.alpha,),
-                pos,
-                max(1, self.brush_size // 3)
-            )
-        self.last_pos = pos
+    def paint(self, bounds, draw_fn, per_tile=True):
+        # draw_fn(surface, offset) is called for each tile of the active
+        # layer under bounds, with offset mapping canvas coordinates onto it;
+        # lines and outlines need per_tile=False to rasterise seamlessly
+        layer = self.layers[self.active_layer]
+        bounds = self.selected_bounds(bounds)
+        if per_tile:
+            return self.edit(lambda: layer.draw(bounds, draw_fn))
+        return self.edit(lambda: layer.draw_region(bounds, draw_fn))
     
-    def draw_brush(self, pos):
+    @profiler.timed
+    def draw_pencil(self, *points):
+        width = max(1, self.brush_size // 3)
         if self.last_pos:
-            points = self.get_points_on_line(self.last_pos, pos)
-            for point in points:
-                pygame.draw.circle(
-                    self.layers[self.active_layer],
-                    self.color + (self.alpha,),
-                    point,
-                    self.brush_size // 2
-                )
-        else:
-            pygame.draw.circle(
-                self.layers[self.active_layer],
-                self.color + (self.alpha,),
-                pos,
-                self.brush_size // 2
-            )
-        self.last_pos = pos
-    
-    def draw_spray(self, pos):
-        num_particles = self.brush_size * 2
-        for _ in range(num_particles):
-            angle = np.random.uniform(0, 2 * np.pi)
-            radius = np.random.uniform(0, self.brush_size)
-            x = int(pos[0] + radius * np.cos(angle))
-            y = int(pos[1] + radius * np.sin(angle))
-            if 0 <= x < self.width and 0 <= y < self.height:
-                spray_alpha = int(np.random.uniform(100, self.alpha))
-                pygame.draw.circle(
-                    self.layers[self.active_layer],
-                    self.color + (spray_alpha,),
-                    (x, y),
-                    1
-                )
+            points = [self.last_pos] + list(points)
+        xs = [x for x, _ in points]
+        ys = [y for _, y in points]
+        bounds = pygame.Rect(min(xs), min(ys), max(xs) - min(xs) + 1, max(ys) - min(ys) + 1).inflate(width * 2 + 2, width * 2 + 2)
+        
+        def draw(surface, offset):
+            shifted = [(x + offset[0], y + offset[1]) for x, y in points]
+            if self.last_pos:
+                return pygame.draw.lines(surface, self.color + (self.alpha,), False, shifted, width)
+            rect = pygame.draw.circle(surface, self.color + (self.alpha,), shifted[0], width)
+            if len(shifted) > 1:
+                rect.union_ip(pygame.draw.lines(surface, self.color + (self.alpha,), False, shifted, width))
+            return rect
+        
+        self.paint(bounds, draw, per_tile=False)
+        self.last_pos = points[-1]
     
-    def draw_eraser(self, pos):
-        if self.last_pos:
-            points = self.get_points_on_line(self.last_pos, pos)
-            for point in points:
-                pygame.draw.circle(
-                    self.layers[self.active_layer],
-                    (0, 0, 0, 0),
-                    point,
-                    self.brush_size
-                )
-        else:
-            pygame.draw.circle(
-                self.layers[self.active_layer],
-                (0, 0, 0, 0),
-                pos,
-                self.brush_size
-            )
-        self.last_pos = pos
+    @profiler.timed
+    def draw_brush(self, *points):
+        radius = max(1, self.brush_size // 2)
+        dab = self.dabs.get(radius, self.color, self.alpha, self.brush_hardness)
+        centers = self.selected_centers(self.get_dab_centers(points, radius), radius)
+        self.edit(lambda: brushes.stamp(self.layers[self.active_layer], dab, radius, centers))
+    
+    def get_dab_centers(self, points, radius):
+        # dab centres along last_pos -> points, spaced as a fraction of the
+        # diameter and continuing the spacing of the stroke so far
+        spacing = max(1, self.brush_spacing * radius * 2)
+        centers = []
+        if self.last_pos is None:
+            centers.append(points[0])
+            self.dab_carry = 0
+            self.last_pos = points[0]
+        
+        for pos in points:
+            positions, self.dab_carry = brushes.dab_positions(self.last_pos, pos, spacing, self.dab_carry)
+            centers.extend(positions)
+            self.last_pos = pos
+        return centers
+    
+    @profiler.timed
+    def draw_spray(self, *points):
+        centers = self.selected_centers(self.get_dab_centers(points, self.brush_size), self.brush_size)
+        self.edit(lambda: brushes.spray(
+            self.layers[self.active_layer],
+            centers,
+            self.brush_size,
+            self.color,
+            self.alpha,
+            self.brush_size * self.spray_density,
+            self.spray_rng
+        ))
+    
+    def seed_spray(self, seed=None):
+        # the generator is made when first sprayed with: importing
+        # numpy.random is a noticeable part of start-up
+        self.spray_seed = seed
+        self._spray_rng = None
+    
+    @property
+    def spray_rng(self):
+        if self._spray_rng is None:
+            self._spray_rng = np.random.default_rng(self.spray_seed)
+        return self._spray_rng
+    
+    @profiler.timed
+    def draw_eraser(self, *points):
+        radius = max(1, self.brush_size)
+        dab = self.dabs.get(radius, (0, 0, 0), 0, self.brush_hardness, erase=True)
+        centers = self.selected_centers(self.get_dab_centers(points, radius), radius)
+        self.edit(lambda: brushes.stamp(
+            self.layers[self.active_layer],
+            dab,
+            radius,
+            centers,
+            pygame.BLEND_RGBA_MULT
+        ))
+    
+    def draw_stroke(self, points):
+        started = time.perf_counter()
+        if not self.replaying:
+            self.stroke_segments.append(points)
+        if self.stroke_smoothing and self.last_pos:
+            points = brushes.smooth_points(self.last_pos, points, self.stroke_smoothing)
+        
+        if self.current_tool == Tool.PENCIL:
+            self.draw_pencil(*points)
+        elif self.current_tool == Tool.BRUSH:
+            self.draw_brush(*points)
+        elif self.current_tool == Tool.SPRAY:
+            self.draw_spray(*points)
+        elif self.current_tool == Tool.ERASER:
+            self.draw_eraser(*points)
+        self.history.spend(time.perf_counter() - started)
+    
+    def flush_stroke(self):
+        # motion events are queued per frame and drawn as one polyline
+        if self.stroke_points:
+            self.draw_stroke(self.stroke_points)
+            self.stroke_points = []
     
     def start_shape(self, pos):
         self.start_pos = pos
         self.save_state()
     
+    def get_preview_surface(self, rect):
+        # reusable scratch surface holding a copy of the active layer under
+        # rect at (0, 0); it only grows, so dragging allocates nothing
+        width, height = self.preview_surface.get_size()
+        if rect.width > width or rect.height > height:
+            self.preview_surface = pygame.Surface(
+                (max(rect.width, width), max(rect.height, height)), pygame.SRCALPHA
+            )
+        
+        preview = self.preview_surface
+        preview.set_clip(None)
+        preview.fill((0, 0, 0, 0), (0, 0, rect.width, rect.height))
+        self.layers[self.active_layer].blit_to(preview, (0, 0), rect, pygame.BLEND_RGBA_ADD)
+        preview.set_clip((0, 0, rect.width, rect.height))
+        return preview
+    
+    def get_preview_rect(self, rect):
+        return rect.clip(0, 0, self.width, self.height)
+    
+    @profiler.timed
     def draw_line_preview(self, pos):
         if self.start_pos:
-            preview = self.layers[self.active_layer].copy()
+            rect = self.get_preview_rect(
+                self.get_rect_from_points(self.start_pos, pos).inflate(self.brush_size * 2 + 2, self.brush_size * 2 + 2)
+            )
+            preview = self.get_preview_surface(rect)
             pygame.draw.line(
                 preview,
                 self.color + (self.alpha,),
-                self.start_pos,
-                pos,
+                (self.start_pos[0] - rect.x, self.start_pos[1] - rect.y),
+                (pos[0] - rect.x, pos[1] - rect.y),
                 self.brush_size
             )
-            return preview
+            return preview, rect
         return None
     
+    @profiler.timed
     def draw_rectangle_preview(self, pos):
         if self.start_pos:
-            preview = self.layers[self.active_layer].copy()
-            rect = self.get_rect_from_points(self.start_pos, pos)
+            shape = self.get_rect_from_points(self.start_pos, pos)
+            rect = self.get_preview_rect(shape.inflate(2, 2))
+            preview = self.get_preview_surface(rect)
+            shape.move_ip(-rect.x, -rect.y)
         
             if self.fill_color:
                 pygame.draw.rect(
                     preview,
                     self.fill_color + (self.alpha,),
-                    rect
+                    shape
                 )
             
             pygame.draw.rect(
                 preview,
                 self.color + (self.alpha,),
-                rect,
+                shape,
                 max(1, self.brush_size // 2)
             )
-            return preview
+            return preview, rect
         return None
     
+    @profiler.timed
     def draw_circle_preview(self, pos):
         if self.start_pos:
-            preview = self.layers[self.active_layer].copy()
             radius = int(math.hypot(pos[0] - self.start_pos[0], pos[1] - self.start_pos[1]))
+            rect = self.get_preview_rect(
+                pygame.Rect(self.start_pos[0] - radius - 1, self.start_pos[1] - radius - 1, radius * 2 + 3, radius * 2 + 3)
+            )
+            preview = self.get_preview_surface(rect)
+            center = (self.start_pos[0] - rect.x, self.start_pos[1] - rect.y)
         
             if self.fill_color:
                 pygame.draw.circle(
                     preview,
                     self.fill_color + (self.alpha,),
-                    self.start_pos,
+                    center,
                     radius
                 )
             
             pygame.draw.circle(
                 preview,
                 self.color + (self.alpha,),
-                self.start_pos,
+                center,
                 radius,
                 max(1, self.brush_size // 2)
             )
-            return preview
+            return preview, rect
         return None
     
+    @profiler.timed
     def draw_gradient_preview(self, pos):
         if self.start_pos:
-            preview = self.layers[self.active_layer].copy()
-            dx = pos[0] - self.start_pos[0]
-            dy = pos[1] - self.start_pos[1]
-            distance = max(1, math.hypot(dx, dy))
-            
-            for x in range(min(self.start_pos[0], pos[0]), max(self.start_pos[0], pos[0])+1, 2):
-                for y in range(min(self.start_pos[1], pos[1]), max(self.start_pos[1], pos[1])+1, 2):
-                    t = ((x - self.start_pos[0]) * dx + (y - self.start_pos[1]) * dy) / (distance * distance)
-                    t = max(0, min(1, t))
-
-                    r = int(self.gradient_start[0] * (1 - t) + self.gradient_end[0] * t)
-                    g = int(self.gradient_start[1] * (1 - t) + self.gradient_end[1] * t)
-                    b = int(self.gradient_start[2] * (1 - t) + self.gradient_end[2] * t)
-                    
-                    pygame.draw.circle(preview, (r, g, b, self.alpha), (x, y), 1)
-            
-            return preview
+            rect = self.get_preview_rect(gradient.gradient_rect(self.start_pos, pos, self.gradient_mode))
+            preview = self.get_preview_surface(rect)
+            gradient.draw_gradient(
+                preview,
+                self.start_pos,
+                pos,
+                self.gradient_start,
+                self.gradient_end,
+                self.alpha,
+                self.gradient_mode,
+                (-rect.x, -rect.y)
+            )
+            return preview, rect
         return None
     
+    @profiler.timed
     def finish_shape(self, pos):
         if self.start_pos:
+            start = self.start_pos
             if self.current_tool == Tool.LINE:
-                pygame.draw.line(
-                    self.layers[self.active_layer],
-                    self.color + (self.alpha,),
-                    self.start_pos,
-                    pos,
-                    self.brush_size
-                )
+                bounds = self.get_rect_from_points(start, pos).inflate(self.brush_size * 2 + 2, self.brush_size * 2 + 2)
+                
+                def draw(surface, offset):
+                    return pygame.draw.line(
+                        surface,
+                        self.color + (self.alpha,),
+                        (start[0] + offset[0], start[1] + offset[1]),
+                        (pos[0] + offset[0], pos[1] + offset[1]),
+                        self.brush_size
+                    )
             elif self.current_tool == Tool.RECTANGLE:
-                rect = self.get_rect_from_points(self.start_pos, pos)
-                if self.fill_color:
-                    pygame.draw.rect(
-                        self.layers[self.active_layer],
-                        self.fill_color + (self.alpha,),
-                        rect
+                shape = self.get_rect_from_points(start, pos)
+                bounds = shape.inflate(2, 2)
+                
+                def draw(surface, offset):
+                    rect = shape.move(offset)
+                    if self.fill_color:
+                        pygame.draw.rect(
+                            surface,
+                            self.fill_color + (self.alpha,),
+                            rect
+                        )
+                    return pygame.draw.rect(
+                        surface,
+                        self.color + (self.alpha,),
+                        rect,
+                        max(1, self.brush_size // 2)
                     )
-                pygame.draw.rect(
-                    self.layers[self.active_layer],
-                    self.color + (self.alpha,),
-                    rect,
-                    max(1, self.brush_size // 2)
-                )
             elif self.current_tool == Tool.CIRCLE:
-                radius = int(math.hypot(pos[0] - self.start_pos[0], pos[1] - self.start_pos[1]))
-                if self.fill_color:
+                radius = int(math.hypot(pos[0] - start[0], pos[1] - start[1]))
+                bounds = pygame.Rect(start[0] - radius - 1, start[1] - radius - 1, radius * 2 + 3, radius * 2 + 3)
+                
+                def draw(surface, offset):
+                    center = (start[0] + offset[0], start[1] + offset[1])
+                    if self.fill_color:
+                        pygame.draw.circle(
+                            surface,
+                            self.fill_color + (self.alpha,),
+                            center,
+                            radius
+                        )
                     pygame.draw.circle(
-                        self.layers[self.active_layer],
-                        self.fill_color + (self.alpha,),
-                        self.start_pos,
-                        radius
+                        surface,
+                        self.color + (self.alpha,),
+                        center,
+                        radius,
+                        max(1, self.brush_size // 2)
                     )
-                pygame.draw.circle(
-                    self.layers[self.active_layer],
-                    self.color + (self.alpha,),
-                    self.start_pos,
-                    radius,
-                    max(1, self.brush_size // 2)
-                )
+                    # pygame under-reports the rect of clipped outlines
+                    return pygame.Rect(center[0] - radius, center[1] - radius, radius * 2 + 1, radius * 2 + 1)
             elif self.current_tool == Tool.GRADIENT:
-                dx = pos[0] - self.start_pos[0]
-                dy = pos[1] - self.start_pos[1]
-                distance = max(1, math.hypot(dx, dy))
+                bounds = gradient.gradient_rect(start, pos, self.gradient_mode)
                 
-                for x in range(min(self.start_pos[0], pos[0]), max(self.start_pos[0], pos[0])+1):
-                    for y in range(min(self.start_pos[1], pos[1]), max(self.start_pos[1], pos[1])+1):
-                        t = ((x - self.start_pos[0]) * dx + (y - self.start_pos[1]) * dy) / (distance * distance)
-                        t = max(0, min(1, t))
-                        
-                        r = int(self.gradient_start[0] * (1 - t) + self.gradient_end[0] * t)
-                        g = int(self.gradient_start[1] * (1 - t) + self.gradient_end[1] * t)
-                        b = int(self.gradient_start[2] * (1 - t) + self.gradient_end[2] * t)
-                        
-                        pygame.draw.circle(self.layers[self.active_layer], (r, g, b, self.alpha), (x, y), 1)
+                def draw(surface, offset):
+                    return gradient.draw_gradient(
+                        surface,
+                        start,
+                        pos,
+                        self.gradient_start,
+                        self.gradient_end,
+                        self.alpha,
+                        self.gradient_mode,
+                        offset
+                    )
             
+            self.paint(bounds, draw, self.current_tool == Tool.GRADIENT)
             self.start_pos = None
+            self.commit_state("shape", start=start, end=pos)
     
     def get_rect_from_points(self, start, end):
         x = min(start[0], end[0])
@@ -329,37 +896,7 @@ class DrawingEngine:
         h = abs(start[1] - end[1])
         return pygame.Rect(x, y, w, h)
     
-    def get_points_on_line(self, start, end):
-        points = []
-        dx = abs(end[0] - start[0])
-        dy = abs(end[1] - start[1])
-        
-        sx = 1 if start[0] < end[0] else -1
-        sy = 1 if start[1] < end[1] else -1
-        
-        err = dx - dy
-        
-        x, y = start
-        
-        while True:
-            points.append((x, y))
-            if x == end[0] and y == end[1]:
-                break
-                
-            e2 = 2 * err
-            if e2 > -dy:
-                if x == end[0]:
-                    break
-                err -= dy
-                x += sx
-            if e2 < dx:
-                if y == end[1]:
-                    break
-                err += dx
-                y += sy
-                
-        return points
-    
+    @profiler.timed
     def flood_fill(self, pos):
         x, y = pos
         if not (0 <= x < self.width and 0 <= y < self.height):
@@ -368,34 +905,39 @@ class DrawingEngine:
         target_color = tuple(self.layers[self.active_layer].get_at((x, y)))
         replacement_color = self.color + (self.alpha,)
 
-        if target_color == replacement_color:
+        if self.fill_tolerance == 0 and target_color == replacement_color:
             return
+        # the fill spreads through the selected pixels only
+        bounds = limit = None
+        if self.selection is not None:
+            if not self.selection.rect.collidepoint(pos):
+                return
+            bounds = self.selection.rect
+            limit = self.selection.coverage(bounds) > 0
         
         self.save_state()
-        
-    
-        stack = [(x, y)]
-        while stack:
-            x, y = stack.pop()
-            
-            if not (0 <= x < self.width and 0 <= y < self.height):
-                continue
-                
-            if tuple(self.layers[self.active_layer].get_at((x, y))) != target_color:
-                continue
-            
-            self.layers[self.active_layer].set_at((x, y), replacement_color)
-            
-            stack.append((x + 1, y))
-            stack.append((x - 1, y))
-            stack.append((x, y + 1))
-            stack.append((x, y - 1))
+        self.edit(lambda: fill.flood_fill(
+            self.layers[self.active_layer],
+            pos,
+            replacement_color,
+            self.fill_tolerance,
+            self.fill_connectivity,
+            bounds,
+            limit
+        ))
+        self.commit_state("fill", pos=pos)
     
+    @profiler.timed
     def place_text(self, pos):
-        if self.text_input:
-            text_surf = self.font.render(self.text_input, True, self.color)
-            self.layers[self.active_layer].blit(text_surf, pos)
+        text = self.text_input
+        if text:
+            text_surf = self.text_cache.render(self.font, text, self.color)
+            self.paint(
+                text_surf.get_rect(topleft=pos),
+                lambda surface, offset: surface.blit(text_surf, (pos[0] + offset[0], pos[1] + offset[1]))
+            )
             self.text_input = ""
+        self.commit_state("text", pos=pos, text=text)
     
     def handle_tool_selection(self, key):
         tool_map = {
@@ -413,6 +955,12 @@ class DrawingEngine:
         
         if key in tool_map:
             self.current_tool = tool_map[key]
+        elif key == pygame.K_w:
+            # rectangle, ellipse and magic wand selection in turn
+            if self.current_tool in SELECT_TOOLS:
+                self.current_tool = SELECT_TOOLS[(SELECT_TOOLS.index(self.current_tool) + 1) % len(SELECT_TOOLS)]
+            else:
+                self.current_tool = SELECT_TOOLS[0]
 
     
     def handle_key_press(self, key):
@@ -430,6 +978,21 @@ class DrawingEngine:
             self.brush_size = min(100, self.brush_size + 1)
         elif key == pygame.K_MINUS:
             self.brush_size = max(1, self.brush_size - 1)
+        elif key == pygame.K_RIGHTBRACKET:
+            self.fill_tolerance = min(255, self.fill_tolerance + 8)
+        elif key == pygame.K_LEFTBRACKET:
+            self.fill_tolerance = max(0, self.fill_tolerance - 8)
+        elif key == pygame.K_n:
+            self.fill_connectivity = 8 if self.fill_connectivity == 4 else 4
+        elif key == pygame.K_h:
+            hardness = [1.0, 0.75, 0.5, 0.25]
+            current_idx = hardness.index(self.brush_hardness) if self.brush_hardness in hardness else 0
+            self.brush_hardness = hardness[(current_idx + 1) % len(hardness)]
+        elif key == pygame.K_g:
+            if self.gradient_mode == gradient.GradientMode.LINEAR:
+                self.gradient_mode = gradient.GradientMode.RADIAL
+            else:
+                self.gradient_mode = gradient.GradientMode.LINEAR
         elif key == pygame.K_c:
             colors = [(0, 0, 0), (255, 0, 0), (0, 255, 0), (0, 0, 255), 
                      (255, 255, 0), (255, 0, 255), (0, 255, 255), (255, 255, 255)]
@@ -442,106 +1005,291 @@ class DrawingEngine:
                 self.fill_color = None
         elif key == pygame.K_s:
             self.save_drawing()
+        elif key == pygame.K_p:
+            self.save_project()
+        elif key == pygame.K_o:
+            self.cycle_opacity()
+        elif key == pygame.K_b:
+            self.cycle_blend_mode()
+        elif key == pygame.K_e:
+            formats = export.FORMATS
+            self.export_format = formats[(formats.index(self.export_format) + 1) % len(formats)]
+        elif key == pygame.K_k:
+            levels = [1, 6, 9]
+            current_idx = levels.index(self.export_compression) if self.export_compression in levels else 0
+            self.export_compression = levels[(current_idx + 1) % len(levels)]
+        elif key == pygame.K_F3:
+            self.show_profiler = not self.show_profiler
+            self.profiler.enabled = self.show_profiler or self.profiler.enabled
+            self.overlay_rects.append(self.profiler_rect)
+        elif key == pygame.K_F4:
+            self.export_profile()
+        elif key == pygame.K_F5:
+            self.cycle_filter()
+        elif key == pygame.K_i:
+            self.invert_selection()
+        elif key == pygame.K_j:
+            self.feather_selection()
+        elif key == pygame.K_ESCAPE:
+            self.set_selection(None)
+        elif key == pygame.K_HOME:
+            self.viewport.reset()
+        elif key == pygame.K_PAGEUP:
+            self.viewport.zoom_at(self.viewport.window.center, 1)
+        elif key == pygame.K_PAGEDOWN:
+            self.viewport.zoom_at(self.viewport.window.center, -1)
+        elif key in (pygame.K_LEFT, pygame.K_RIGHT, pygame.K_UP, pygame.K_DOWN):
+            step = 64
+            self.viewport.pan(
+                step * ((key == pygame.K_LEFT) - (key == pygame.K_RIGHT)),
+                step * ((key == pygame.K_UP) - (key == pygame.K_DOWN))
+            )
+    
+    def handle_keydown(self, key, unicode=""):
+        self.flush_stroke()
+        typed = self.current_tool == Tool.TEXT and unicode != "" and unicode.isprintable()
+        if key not in FILE_KEYS or typed:
+            self.record("key", key=pygame.key.name(key), unicode=unicode)
+        if self.handle_filter_key(key):
+            return
+        if self.current_tool == Tool.TEXT and self.handle_text_key(key, unicode):
+            return
+        self.handle_tool_selection(key)
+
+        self.handle_key_press(key)
+    
+    def handle_text_key(self, key, unicode):
+        # while the text tool is out, typing goes into the text and never
+        # reaches the shortcuts; Esc drops the text and puts the tool away
+        if key == pygame.K_BACKSPACE:
+            self.text_input = self.text_input[:-1]
+        elif key == pygame.K_ESCAPE:
+            self.text_input = ""
+            self.current_tool = Tool.PENCIL
+        elif unicode and unicode.isprintable():
+            self.text_input += unicode
+        else:
+            return False
+        return True
     
-    def save_drawing(self):
-        final_surface = pygame.Surface((self.width, self.height), pygame.SRCALPHA)
-        final_surface.fill((255, 255, 255))
+    def handle_mouse_down(self, pos):
+        self.drawing = True
+        # drawing leaves a filter preview
+        self.filter = None
         
-        for layer in self.layers:
-            final_surface.blit(layer, (0, 0))
+        if self.current_tool in [Tool.LINE, Tool.RECTANGLE, Tool.CIRCLE, Tool.GRADIENT]:
+            self.start_shape(pos)
+        elif self.current_tool in SELECT_TOOLS:
+            mods = pygame.key.get_mods()
+            self.selection_mode = "union" if mods & pygame.KMOD_SHIFT else "intersect" if mods & pygame.KMOD_CTRL else "replace"
+            if self.current_tool == Tool.MAGIC_WAND:
+                self.record("select", shape="wand", start=pos, mode=self.selection_mode)
+                self.select("wand", pos, mode=self.selection_mode)
+            else:
+                self.start_pos = pos
+        elif self.current_tool == Tool.FILL:
+            self.record("fill", pos=pos)
+            self.flood_fill(pos)
+        elif self.current_tool == Tool.TEXT:
+            self.record("text", pos=pos, text=self.text_input)
+            self.save_state()
+            self.place_text(pos)
+        else:
+            self.save_state()
+            self.last_pos = None
+            self.stroke_segments = []
+            self.draw_stroke([pos])
+    
+    def handle_mouse_up(self, pos):
+        self.flush_stroke()
+        self.drawing = False
         
-        filename = f"drawing_{pygame.time.get_ticks()}.png"
-        pygame.image.save(final_surface, filename)
-        print(f"Drawing saved as {filename}")
+        if self.current_tool in [Tool.LINE, Tool.RECTANGLE, Tool.CIRCLE, Tool.GRADIENT]:
+            if self.start_pos:
+                self.record("shape", start=self.start_pos, end=pos)
+            self.finish_shape(pos)
+        elif self.current_tool in (Tool.SELECT_RECT, Tool.SELECT_ELLIPSE):
+            if self.start_pos:
+                shape = "rect" if self.current_tool == Tool.SELECT_RECT else "ellipse"
+                self.record("select", shape=shape, start=self.start_pos, end=pos, mode=self.selection_mode)
+                self.select(shape, self.start_pos, pos, self.selection_mode)
+            self.start_pos = None
+        elif self.stroke_segments:
+            self.record("stroke", segments=self.stroke_segments)
+        
+        self.last_pos = None
+        self.commit_state()
+    
+    def record(self, op, **fields):
+        # append one command to the session log, in the format replay.py reads
+        if self.recorder:
+            self.recorder.write(json.dumps({"op": op, **fields}) + "\n")
+    
+    @profiler.timed
+    def save_drawing(self, filename=None):
+        # only the layers are frozen here; flattening and encoding run on the
+        # export thread while drawing carries on
+        if filename is None:
+            filename = f"drawing_{pygame.time.get_ticks()}.{self.export_format}"
+        self.exporter.submit(filename, (self.width, self.height), export.snapshot(self.layers), self.export_compression)
+        print(f"Exporting drawing as {filename}")
+    
+    def export_status(self):
+        status = self.exporter.status()
+        if status is not None:
+            job, state = status
+            name = os.path.basename(job.path)
+            if state == "exporting":
+                return f"Exporting {name} {job.progress * 100:.0f}%"
+            if state == "queued":
+                return f"Queued {name}"
+            if state == "failed":
+                return f"Export failed: {job.error}"
+            return f"Saved {name}"
+        return f"Export: {self.export_format.upper()} z{self.export_compression}"
+    
+    @profiler.timed
+    def save_project(self, path=None):
+        # after the first save only tiles drawn into since are written
+        if path is None:
+            path = self.project_path or f"drawing_{pygame.time.get_ticks()}{project.EXTENSION}"
+        project.save(path, self.layers, self.active_layer)
+        self.project_path = path
+        print(f"Project saved as {path}")
+    
+    def load_project(self, path):
+        # layers load lazily: a tile is decoded when it is drawn, shown or saved elsewhere
+        opened = project.ProjectFile(path)
+        self.layers = opened.layers()
+        self.active_layer = min(opened.meta["active_layer"], len(self.layers) - 1)
+        self.width, self.height = opened.meta["width"], opened.meta["height"]
+        self.history = history.History()
+        self.selection = None
+        self.compositor = compositor.Compositor(self.width, self.height)
+        self.viewport = viewport.Viewport((self.window_width, self.window_height), (self.width, self.height))
+        self.project_path = path
+    
+    def draw_profiler_overlay(self):
+        p50, p95, p99 = self.profiler.percentiles()
+        lines = [
+            f"frame p50 {p50:.2f} ms  p95 {p95:.2f} ms  p99 {p99:.2f} ms  {self.clock.get_fps():.0f} fps",
+            "  ".join(f"{name} {ns / 1e6:.2f}" for name, ns in self.profiler.last_phases.items()),
+        ]
+        self.screen.fill((0, 0, 0), self.profiler_rect)
+        for i, line in enumerate(lines):
+            self.screen.blit(self.ui_font.render(line, True, (0, 255, 0)), (6, 4 + i * 20))
+        return self.profiler_rect
+    
+    def report_startup(self):
+        # how long it took from main.py starting to the first frame being
+        # shown, split at the engine's setup; kept for F4's trace, and only
+        # printed when start-up is being timed or profiled
+        now = time.perf_counter()
+        phases = [
+            ("imports", STARTED, self.setup_started),
+            ("setup", self.setup_started, self.setup_finished),
+            ("first frame", self.setup_finished, now),
+        ]
+        for name, start, end in phases:
+            self.profiler.events.append((name, "startup", int(start * 1e9), int((end - start) * 1e9)))
+        if not (self.startup_only or self.profiler.enabled):
+            return
+        print(f"Started in {(now - STARTED) * 1000:.0f} ms ("
+              + ", ".join(f"{name} {(end - start) * 1000:.0f}" for name, start, end in phases) + ")")
+    
+    def export_profile(self):
+        stamp = pygame.time.get_ticks()
+        self.profiler.export_chrome_trace(f"trace_{stamp}.json")
+        self.profiler.export_csv(f"trace_{stamp}.csv")
+        print(f"Profile saved as trace_{stamp}.json and trace_{stamp}.csv")
+    
+    def record_to(self, path):
+        # spray is the only random tool; log its seed so replays match
+        self.recorder = open(path, "w")
+        seed = random.randrange(2 ** 32)
+        self.seed_spray(seed)
+        self.record("size", width=self.width, height=self.height)
+        self.record("seed", seed=seed)
+    
+    def on_canvas(self, pos):
+        # screen positions over the panel never reach the tools
+        return pos[1] < self.window_height - self.ui_panel_height
+    
+    def frame_timeout(self):
+        # None while frames are needed back to back; otherwise how long, in
+        # ms, the loop may block waiting for input before looking again
+        if self.drawing or self.panning or self.stroke_points or self.overlay_rects:
+            return None
+        if self.compositor.dirty or self.show_profiler:
+            return None
+        status = self.exporter.status()
+        if status is not None and status[1] in ("exporting", "queued"):
+            return 100
+        return 1000
     
     def run(self):
+        first_frame = True
 
         while self.running:
-            self.clock.tick(60)
-            
-            self.screen.fill((200, 200, 200))
+            timeout = self.frame_timeout()
+            events = []
+            if timeout is None:
+                self.clock.tick(60)
+            else:
+                # idle: sleep until input arrives or the timeout passes
+                event = pygame.event.wait(timeout)
+                if event.type != pygame.NOEVENT:
+                    events.append(event)
+                self.clock.tick()
+            self.profiler.start_frame()
             
 
-            for event in pygame.event.get():
+            for event in events + pygame.event.get():
                 if event.type == pygame.QUIT:
                     self.running = False
                 
                 elif event.type == pygame.KEYDOWN:
-                    self.handle_tool_selection(event.key)
-
-                    self.handle_key_press(event.key)
-                    
-
-                    if self.current_tool == Tool.TEXT:
-                        if event.key == pygame.K_RETURN:
-                            pass 
-                        elif event.key == pygame.K_BACKSPACE:
-                            self.text_input = self.text_input[:-1]
-                        else:
-                            if event.unicode.isprintable():
-                                self.text_input += event.unicode
+                    self.handle_keydown(event.key, event.unicode)
                 
                 elif event.type == pygame.MOUSEBUTTONDOWN:
                     if event.button == 1:
-                        if event.pos[1] < self.height - self.ui_panel_height:
-                            self.drawing = True
-                            pos = event.pos
-                            
-                            if self.current_tool in [Tool.LINE, Tool.RECTANGLE, Tool.CIRCLE, Tool.GRADIENT]:
-                                self.start_shape(pos)
-                            elif self.current_tool == Tool.FILL:
-                                self.flood_fill(pos)
-                            elif self.current_tool == Tool.TEXT:
-                                self.save_state()
-                                self.place_text(pos)
-                            else:
-                                self.save_state()
-                                self.last_pos = None
-                                if self.current_tool == Tool.PENCIL:
-                                    self.draw_pencil(pos)
-                                elif self.current_tool == Tool.BRUSH:
-                                    self.draw_brush(pos)
-                                elif self.current_tool == Tool.SPRAY:
-                                    self.draw_spray(pos)
-                                elif self.current_tool == Tool.ERASER:
-                                    self.draw_eraser(pos)
+                        if self.on_canvas(event.pos):
+                            self.handle_mouse_down(self.viewport.to_document(event.pos))
+                    elif event.button == 2:
+                        self.panning = True
                 
                 elif event.type == pygame.MOUSEBUTTONUP:
                     if event.button == 1:
-                        self.drawing = False
-                        pos = event.pos
-                        
-    
-                        if self.current_tool in [Tool.LINE, Tool.RECTANGLE, Tool.CIRCLE, Tool.GRADIENT]:
-                            self.finish_shape(pos)
-                        
-                        self.last_pos = None
+                        self.handle_mouse_up(self.viewport.to_document(event.pos))
+                    elif event.button == 2:
+                        self.panning = False
                 
                 elif event.type == pygame.MOUSEMOTION:
-                    if self.drawing and event.pos[1] < self.height - self.ui_panel_height:
-                        pos = event.pos
-                        
-                        if self.current_tool == Tool.PENCIL:
-                            self.draw_pencil(pos)
-                        elif self.current_tool == Tool.BRUSH:
-                            self.draw_brush(pos)
-                        elif self.current_tool == Tool.SPRAY:
-                            self.draw_spray(pos)
-                        elif self.current_tool == Tool.ERASER:
-                            self.draw_eraser(pos)
+                    if self.panning:
+                        self.viewport.pan(*event.rel)
+                    elif self.drawing and self.on_canvas(event.pos):
+                        self.stroke_points.append(self.viewport.to_document(event.pos))
+                
+                elif event.type == pygame.MOUSEWHEEL:
+                    if event.y:
+                        self.viewport.zoom_at(pygame.mouse.get_pos(), 1 if event.y > 0 else -1)
+                
+                elif event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+                    self.compositor.mark_all()
+                    self.ui_state = None
             
-            for y in range(0, self.height, 20):
-                for x in range(0, self.width, 20):
-                    color = (240, 240, 240) if (x // 20 + y // 20) % 2 == 0 else (220, 220, 220)
-                    pygame.draw.rect(self.screen, color, (x, y, 20, 20))
+            self.profiler.phase("events")
+            self.flush_stroke()
+            self.profiler.phase("stroke")
             
-
-            for layer in self.layers:
-                self.screen.blit(layer, (0, 0))
+            for rect in self.overlay_rects:
+                self.mark_dirty(rect)
+            self.overlay_rects = []
             
-            mouse_pos = pygame.mouse.get_pos()
-            if self.drawing and mouse_pos[1] < self.height - self.ui_panel_height:
-                preview = None
+            screen_pos = pygame.mouse.get_pos()
+            mouse_pos = self.viewport.to_document(screen_pos)
+            preview = None
+            if self.drawing and self.on_canvas(screen_pos):
                 if self.current_tool == Tool.LINE:
                     preview = self.draw_line_preview(mouse_pos)
                 elif self.current_tool == Tool.RECTANGLE:
@@ -552,20 +1300,104 @@ class DrawingEngine:
                     preview = self.draw_gradient_preview(mouse_pos)
                 
                 if preview:
-                    self.screen.blit(preview, (0, 0))
+                    preview = self.confine_preview(preview)
+                if preview:
+                    self.mark_dirty(preview[1])
+                    self.overlay_rects.append(preview[1])
             
-            self.draw_ui()
+            # the selection being dragged out is outlined over the frame
+            selecting = None
+            if self.drawing and self.start_pos and self.current_tool in (Tool.SELECT_RECT, Tool.SELECT_ELLIPSE):
+                selecting = self.get_rect_from_points(self.start_pos, mouse_pos)
+                self.mark_dirty(selecting.inflate(2, 2))
+                self.overlay_rects.append(selecting.inflate(2, 2))
             
+            text_surf = None
+            text_preview = None
             if self.current_tool == Tool.TEXT and self.text_input:
-                text_surf = self.font.render(self.text_input, True, self.color)
-                mouse_pos = pygame.mouse.get_pos()
-                if mouse_pos[1] < self.height - self.ui_panel_height:
-                    self.screen.blit(text_surf, mouse_pos)
+                if self.on_canvas(screen_pos):
+                    text_surf = self.text_cache.render(self.font, self.text_input, self.color)
+                    text_rect = text_surf.get_rect(topleft=mouse_pos)
+                    if self.viewport.zoom != 1:
+                        text_surf = self.text_cache.render(self.font, self.text_input, self.color, self.viewport.zoom)
+                    text_preview = (self.text_input, self.color, text_rect, self.viewport.key())
+            if text_preview != self.text_preview:
+                # moved or edited: wipe the old preview, the new one is drawn below
+                if self.text_preview:
+                    self.mark_dirty(self.text_preview[2])
+                    if self.text_preview_rect.colliderect(self.ui_panel_rect):
+                        self.ui_state = None
+                if text_preview:
+                    self.mark_dirty(text_rect)
+                self.text_preview = text_preview
+            
+            filter_preview = self.update_filter_preview()
+            if preview is None:
+                preview = filter_preview
+            
+            if self.show_profiler:
+                profiler_rect = self.viewport.to_document_rect(self.profiler_rect)
+                self.mark_dirty(profiler_rect)
+                self.overlay_rects.append(profiler_rect)
+            self.profiler.phase("preview")
+            
+            dirty_rects = self.compositor.compose(self.screen, self.layers, self.active_layer, self.viewport, preview)
+            self.profiler.phase("composite")
+            outline_rect = self.draw_selection_outline(dirty_rects)
+            if outline_rect:
+                dirty_rects.append(outline_rect)
+            if selecting:
+                draw = pygame.draw.rect if self.current_tool == Tool.SELECT_RECT else pygame.draw.ellipse
+                dirty_rects.append(draw(self.screen, (0, 0, 0), self.viewport.to_screen_rect(selecting), 1))
+            ui_rect = self.draw_ui(dirty_rects)
+            if ui_rect:
+                dirty_rects.append(ui_rect)
             
-            pygame.display.flip()
+            if text_surf:
+                # only drawn again when something was drawn over it
+                self.text_preview_rect = text_surf.get_rect(topleft=self.viewport.to_screen(mouse_pos))
+                if self.text_preview_rect.collidelist(dirty_rects) != -1:
+                    dirty_rects.append(self.screen.blit(text_surf, self.text_preview_rect))
+            
+            if self.show_profiler:
+                dirty_rects.append(self.draw_profiler_overlay())
+            self.profiler.phase("ui")
+            
+            if dirty_rects:
+                pygame.display.update(dirty_rects)
+            self.profiler.phase("present")
+            self.profiler.end_frame()
+            
+            if first_frame:
+                first_frame = False
+                self.report_startup()
+                if self.startup_only:
+                    self.running = False
         
+        if self.recorder:
+            self.recorder.close()
+        self.exporter.wait()
         pygame.quit()
 
 if __name__ == "__main__":
-    engine = DrawingEngine(1024, 768)
+    parser = argparse.ArgumentParser(description="FreakDraw 2")
+    parser.add_argument("--record", metavar="PATH", help="log the session as JSON lines for replay.py")
+    parser.add_argument("--profile", action="store_true", help="record frame and tool timings from startup (F4 exports them)")
+    parser.add_argument("--size", default="1024x768", help="document size as WxH (default: the window size, 1024x768)")
+    parser.add_argument("--startup", action="store_true", help="quit once the first frame is shown, to time start-up")
+    parser.add_argument("project", nargs="?", help=f"{project.EXTENSION} project to open, or to create on the first save (P)")
+    args = parser.parse_args()
+    
+    width, height = (int(v) for v in args.size.lower().split("x"))
+    if args.project and os.path.exists(args.project):
+        width, height = project.read_size(args.project)
+    engine = DrawingEngine(width, height, window_size=(1024, 768))
+    if args.project and os.path.exists(args.project):
+        engine.load_project(args.project)
+    elif args.project:
+        engine.project_path = args.project
+    if args.record:
+        engine.record_to(args.record)
+    engine.profiler.enabled = args.profile
+    engine.startup_only = args.startup
     engine.run()
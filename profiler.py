@@ -0,0 +1,85 @@
+from collections import deque
+import csv
+import functools
+import json
+import time
+
+import numpy as np
+
+
+class Profiler:
+    def __init__(self, capacity=8192, frames=600):
+        # events are (name, category, start_ns, duration_ns); both buffers
+        # drop their oldest entries once full
+        self.enabled = False
+        self.in_frame = False
+        self.events = deque(maxlen=capacity)
+        self.frame_times = deque(maxlen=frames)
+        self.last_phases = {}
+        self._frame_start = 0
+        self._phase_start = 0
+        self._phases = {}
+
+    def start_frame(self):
+        # a frame is only timed if profiling was on when it started
+        self.in_frame = self.enabled
+        if self.in_frame:
+            self._frame_start = self._phase_start = time.perf_counter_ns()
+            self._phases = {}
+
+    def phase(self, name):
+        # close the phase that started at the previous mark
+        if self.in_frame:
+            now = time.perf_counter_ns()
+            self.events.append((name, "phase", self._phase_start, now - self._phase_start))
+            self._phases[name] = self._phases.get(name, 0) + now - self._phase_start
+            self._phase_start = now
+
+    def end_frame(self):
+        if self.in_frame:
+            now = time.perf_counter_ns()
+            self.events.append(("frame", "frame", self._frame_start, now - self._frame_start))
+            self.frame_times.append(now - self._frame_start)
+            self.last_phases = self._phases
+
+    def record(self, name, category, start_ns):
+        self.events.append((name, category, start_ns, time.perf_counter_ns() - start_ns))
+
+    def percentiles(self, points=(50, 95, 99)):
+        if not self.frame_times:
+            return [0.0] * len(points)
+        return (np.percentile(np.fromiter(self.frame_times, dtype=np.int64), points) / 1e6).tolist()
+
+    def export_csv(self, path):
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["name", "category", "start_us", "duration_us"])
+            for name, category, start, duration in self.events:
+                writer.writerow([name, category, start / 1000, duration / 1000])
+
+    def export_chrome_trace(self, path):
+        # loadable in chrome://tracing or https://ui.perfetto.dev
+        trace = [
+            {"name": name, "cat": category, "ph": "X", "ts": start / 1000, "dur": duration / 1000,
+             "pid": 1, "tid": 1}
+            for name, category, start, duration in self.events
+        ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+
+def timed(method):
+    # record the duration of an engine method while self.profiler is enabled
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        profiler = self.profiler
+        if not profiler.enabled:
+            return method(self, *args, **kwargs)
+        start = time.perf_counter_ns()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            profiler.record(name, "tool", start)
+    return wrapper
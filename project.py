@@ -0,0 +1,168 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+
+import numpy as np
+import pygame
+
+import tiles
+
+# A project file is a header, a heap of zlib-compressed tiles and an index.
+# The header points at the index, which is written after the tiles, so a
+# save appends the tiles that changed and a new index and then rewrites the
+# header; tiles that did not change keep their place in the file.
+MAGIC = b"FDPROJ\r\n"
+VERSION = 1
+HEADER = struct.Struct("<8sIQQ")
+# one row per tile: tx, ty, offset, length
+ENTRY = np.dtype("<i8")
+EXTENSION = ".fdp"
+
+
+class ProjectFile:
+    # an open project file; tiles are decoded from the memory map on demand
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        with open(self.path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, offset, length = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a FreakDraw project")
+        if version > VERSION:
+            raise ValueError(f"{path} needs a newer FreakDraw (format {version})")
+
+        index = zlib.decompress(self.data[offset:offset + length])
+        meta_length, = struct.unpack_from("<I", index)
+        self.meta = json.loads(index[4:4 + meta_length])
+        self.entries = []
+        start = 4 + meta_length
+        for layer in self.meta["layers"]:
+            count = layer["tiles"]
+            rows = np.frombuffer(index, dtype=ENTRY, count=count * 4, offset=start).reshape(count, 4)
+            self.entries.append(rows)
+            start += rows.nbytes
+        self.size = len(self.data)
+
+    def read_tile(self, offset, length, size):
+        pixels = np.frombuffer(zlib.decompress(self.data[offset:offset + length]), dtype=np.uint32)
+        pixels = pixels.reshape(size)
+        tile = pygame.Surface(size, pygame.SRCALPHA)
+        shifts = tuple(self.meta["shifts"])
+        if shifts != tile.get_shifts():
+            channels = [(pixels >> shift) & 0xFF for shift in shifts]
+            pixels = np.bitwise_or.reduce(
+                [channel << shift for channel, shift in zip(channels, tile.get_shifts())]
+            ).astype(np.uint32)
+        pygame.surfarray.pixels2d(tile)[...] = pixels
+        return tile
+
+    def chunk(self, offset, length):
+        return self.data[offset:offset + length]
+
+    def layers(self):
+        # lazily loaded layers: nothing is decoded until a tile is used
+        width, height = self.meta["width"], self.meta["height"]
+        layers = []
+        for rows, info in zip(self.entries, self.meta["layers"]):
+            layer = tiles.TiledLayer(width, height, self.meta["tile_size"])
+            layer.opacity = info.get("opacity", 1.0)
+            layer.blend_mode = info.get("blend_mode", "normal")
+            for tx, ty, offset, length in rows.tolist():
+                layer.sources[(tx, ty)] = (self, offset, length)
+            layer.saved = dict(layer.sources)
+            layers.append(layer)
+        return layers
+
+
+def read_size(path):
+    project = ProjectFile(path)
+    return project.meta["width"], project.meta["height"]
+
+
+def _encode(tile, compression):
+    return zlib.compress(tiles.tile_pixels(tile).tobytes(), compression)
+
+
+def _write_tiles(f, layers, project, compression):
+    # append every tile that is not already in the file behind project and
+    # return the index rows of each layer
+    entries = []
+    for layer in layers:
+        rows = []
+        for key in layer.keys():
+            source = layer.saved.get(key)
+            if source is not None and source[0].path == project:
+                _, offset, length = source
+            else:
+                if source is not None:
+                    # unchanged but stored in another file: copy it over
+                    data = source[0].chunk(source[1], source[2])
+                else:
+                    data = _encode(layer.tile(key), compression)
+                offset = f.tell()
+                length = len(data)
+                f.write(data)
+            rows.append((key[0], key[1], offset, length))
+        entries.append(np.array(rows, dtype=ENTRY).reshape(len(rows), 4))
+    return entries
+
+
+def _write_index(f, layers, entries, active_layer, compression):
+    first = layers[0]
+    meta = {
+        "width": first.width,
+        "height": first.height,
+        "tile_size": first.tile_size,
+        "shifts": list(pygame.Surface((1, 1), pygame.SRCALPHA).get_shifts()),
+        "active_layer": active_layer,
+        "layers": [
+            {"tiles": len(rows), "opacity": layer.opacity, "blend_mode": layer.blend_mode}
+            for layer, rows in zip(layers, entries)
+        ],
+    }
+    meta = json.dumps(meta).encode()
+    index = zlib.compress(
+        struct.pack("<I", len(meta)) + meta + b"".join(rows.tobytes() for rows in entries), compression
+    )
+    offset = f.tell()
+    f.write(index)
+    return offset, len(index)
+
+
+def save(path, layers, active_layer=0, compression=1, max_waste=0.5):
+    # write layers to path and return the reopened ProjectFile. If path is
+    # the project the layers were loaded from or last saved to, only tiles
+    # drawn into since are written; the file is rewritten from scratch once
+    # more than max_waste of it is tiles that are no longer used.
+    path = os.path.abspath(path)
+    live = sum(length for layer in layers for _, _, length in layer.saved.values())
+    append = os.path.exists(path) and any(
+        source[0].path == path for layer in layers for source in layer.saved.values()
+    )
+    if append and os.path.getsize(path) * max_waste > live:
+        append = False
+
+    if append:
+        with open(path, "r+b") as f:
+            f.seek(0, os.SEEK_END)
+            entries = _write_tiles(f, layers, path, compression)
+            offset, length = _write_index(f, layers, entries, active_layer, compression)
+            # the old index stays valid until the header points past it
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, VERSION, offset, length))
+    else:
+        temp = path + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, 0, 0))
+            entries = _write_tiles(f, layers, None, compression)
+            offset, length = _write_index(f, layers, entries, active_layer, compression)
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, VERSION, offset, length))
+        os.replace(temp, path)
+
+    project = ProjectFile(path)
+    for layer, rows in zip(layers, project.entries):
+        layer.saved = {(tx, ty): (project, offset, length) for tx, ty, offset, length in rows.tolist()}
+    return project
@@ -0,0 +1,133 @@
+import argparse
+import json
+import sys
+import time
+
+import pygame
+
+from gradient import GradientMode
+from main import DrawingEngine, Tool
+
+# engine attributes a session may change with {"op": "set", ...}
+SETTINGS = {
+    "brush_size": int,
+    "color": tuple,
+    "fill_color": lambda value: None if value is None else tuple(value),
+    "alpha": int,
+    "gradient_start": tuple,
+    "gradient_end": tuple,
+    "gradient_mode": lambda value: GradientMode[value],
+    "fill_tolerance": int,
+    "fill_connectivity": int,
+    "brush_hardness": float,
+    "brush_spacing": float,
+    "spray_density": int,
+    "stroke_smoothing": float,
+    "export_format": str,
+    "export_compression": int,
+}
+
+
+def read_commands(path):
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if line and not line.startswith("#"):
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise ValueError(f"{path}:{number}: {e}") from None
+
+
+def session_size(path, default):
+    # a recorded session starts with its canvas size
+    for command in read_commands(path):
+        if command["op"] == "size":
+            return command["width"], command["height"]
+        return default
+    return default
+
+
+def apply_command(engine, command):
+    op = command["op"]
+
+    if op == "size":
+        if (command["width"], command["height"]) != (engine.width, engine.height):
+            raise ValueError(f"session is {command['width']}x{command['height']}, "
+                             f"canvas is {engine.width}x{engine.height}")
+    elif op == "seed":
+        engine.seed_spray(command["seed"])
+    elif op == "tool":
+        engine.current_tool = Tool[command["tool"]]
+    elif op == "set":
+        for name, value in command.items():
+            if name == "op":
+                continue
+            if name not in SETTINGS:
+                raise ValueError(f"unknown setting {name!r}")
+            setattr(engine, name, SETTINGS[name](value))
+    elif op == "key":
+        engine.handle_keydown(pygame.key.key_code(command["key"]), command.get("unicode", ""))
+    elif op == "stroke" and "points" in command:
+        # older sessions log a stroke as one list of points
+        points = command["points"]
+        engine.perform({"op": "stroke", "segments": [points[:1], points[1:]]})
+    elif op == "select":
+        engine.select(command["shape"], command["start"], command.get("end"), command.get("mode", "replace"))
+    elif op == "undo":
+        engine.undo()
+    elif op == "redo":
+        engine.redo()
+    elif op == "select_layer":
+        engine.active_layer = max(0, min(len(engine.layers) - 1, command["index"]))
+        engine.compositor.invalidate()
+    elif op == "save":
+        engine.save_drawing(command["path"])
+        engine.exporter.wait()
+    elif op == "save_project":
+        engine.save_project(command["path"])
+    else:
+        # strokes, shapes, fills, text, filters and layer operations
+        engine.perform(command)
+
+
+def replay(engine, commands):
+    count = 0
+    for command in commands:
+        apply_command(engine, command)
+        count += 1
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a FreakDraw session headlessly and save the result")
+    parser.add_argument("session", help="JSON lines file, e.g. one written by main.py --record")
+    parser.add_argument("-o", "--output", default="replay.png", help="image to write (default: replay.png)")
+    parser.add_argument("--size", default=None, help="canvas size as WxH when the session does not record one")
+    args = parser.parse_args(argv)
+
+    size = (1024, 768)
+    if args.size:
+        size = tuple(int(v) for v in args.size.lower().split("x"))
+    size = session_size(args.session, size)
+
+    engine = DrawingEngine(*size, headless=True)
+    start = time.perf_counter()
+    try:
+        count = replay(engine, read_commands(args.session))
+    except (KeyError, ValueError) as e:
+        print(f"replay failed: {e}", file=sys.stderr)
+        return 1
+    elapsed = time.perf_counter() - start
+
+    engine.save_drawing(args.output)
+    job = engine.exporter.wait()
+    if job.error:
+        print(f"export failed: {job.error}", file=sys.stderr)
+        return 1
+    print(f"Replayed {count} commands in {elapsed:.3f}s ({count / max(elapsed, 1e-9):.0f}/s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+import numpy as np
+import pygame
+
+import fill
+import filters
+
+# A selection is a rect in document coordinates and an 8-bit coverage mask
+# for the pixels inside it, indexed [x, y] like TiledLayer.read; nothing
+# outside the rect is selected. A mask of None covers the whole rect, so a
+# rectangle costs no array at all. Selections are never changed in place:
+# every operation returns a new one, so the undo journal can keep them as
+# settings without copying.
+
+FULL = 255
+
+
+class Selection:
+    def __init__(self, size, rect, mask=None):
+        # size is the document's; mask is a (width, height) uint8 array or None
+        self.size = size
+        self.rect = pygame.Rect(rect)
+        self.mask = mask
+
+    def empty(self):
+        return self.rect.width == 0 or self.rect.height == 0
+
+    def coverage(self, rect):
+        # the mask over any rect as a (width, height) uint8 array
+        rect = pygame.Rect(rect)
+        cover = np.zeros(rect.size, dtype=np.uint8)
+        inner = rect.clip(self.rect)
+        if inner.width == 0 or inner.height == 0:
+            return cover
+        dst = (slice(inner.left - rect.left, inner.right - rect.left), slice(inner.top - rect.top, inner.bottom - rect.top))
+        if self.mask is None:
+            cover[dst] = FULL
+        else:
+            cover[dst] = self.mask[inner.left - self.rect.left:inner.right - self.rect.left,
+                                   inner.top - self.rect.top:inner.bottom - self.rect.top]
+        return cover
+
+    def contains(self, xs, ys):
+        # whether each document pixel (xs[i], ys[i]) is at least half selected
+        xs, ys = np.broadcast_arrays(xs, ys)
+        inside = (xs >= self.rect.left) & (xs < self.rect.right) & (ys >= self.rect.top) & (ys < self.rect.bottom)
+        if self.mask is None:
+            return inside
+        hit = np.zeros(inside.shape, dtype=bool)
+        hit[inside] = self.mask[xs[inside] - self.rect.left, ys[inside] - self.rect.top] > FULL // 2
+        return hit
+
+    def union(self, other):
+        if self.empty():
+            return other
+        if other.empty():
+            return self
+        rect = self.rect.union(other.rect)
+        return trimmed(self.size, rect, np.maximum(self.coverage(rect), other.coverage(rect)))
+
+    def intersect(self, other):
+        rect = self.rect.clip(other.rect)
+        return trimmed(self.size, rect, np.minimum(self.coverage(rect), other.coverage(rect)))
+
+    def invert(self):
+        rect = pygame.Rect((0, 0), self.size)
+        return trimmed(self.size, rect, FULL - self.coverage(rect))
+
+    def feather(self, radius):
+        # soften the edge with a Gaussian blur; the mask grows by radius
+        rect = self.rect.inflate(2 * radius, 2 * radius).clip(pygame.Rect((0, 0), self.size))
+        cover = self.coverage(rect).astype(np.float32)[..., None]
+        blurred = filters.gaussian_blur(cover, radius)[..., 0]
+        return trimmed(self.size, rect, np.rint(np.clip(blurred, 0, FULL)).astype(np.uint8))
+
+    def keep(self, layer, before, rect):
+        # rect of layer has just been drawn into, and before is a frozen copy
+        # from before that: put back whatever was drawn outside the mask, and
+        # blend partly selected pixels. Returns the rect that is left changed.
+        rect = pygame.Rect(rect).clip(layer.get_rect())
+        cover = self.coverage(rect)
+        outside = cover < FULL
+        if outside.any():
+            old, new = before.read(rect), layer.read(rect)
+            partly = (cover > 0) & outside
+            if partly.any():
+                old[partly] = mix(old[partly], new[partly], cover[partly], layer.shifts)
+            # only tiles something landed in outside the mask are written
+            outside &= old != new
+            if outside.any():
+                layer.write(rect, old, outside)
+        changed = rect.clip(self.rect)
+        if changed.width == 0 or changed.height == 0:
+            return None
+        return changed
+
+    def outline(self, viewport):
+        # (surface, screen rect) of the selection's edge as it appears in
+        # the view, dashed black and white, or None when none of it shows
+        screen_rect = viewport.to_screen_rect(self.rect.inflate(2, 2)).clip(viewport.window)
+        if screen_rect.width == 0 or screen_rect.height == 0:
+            return None
+        # sample the mask at the centre of every screen pixel, with a ring
+        # around them for the neighbours
+        sx = np.arange(screen_rect.left - 1, screen_rect.right + 1)
+        sy = np.arange(screen_rect.top - 1, screen_rect.bottom + 1)
+        xs = np.floor((sx + 0.5 - viewport.origin[0]) / viewport.zoom).astype(np.int64)
+        ys = np.floor((sy + 0.5 - viewport.origin[1]) / viewport.zoom).astype(np.int64)
+        inside = self.contains(xs[:, None], ys[None, :])
+        core = inside[1:-1, 1:-1]
+        edge = core & ~(inside[:-2, 1:-1] & inside[2:, 1:-1] & inside[1:-1, :-2] & inside[1:-1, 2:])
+        if not edge.any():
+            return None
+
+        dashes = ((sx[1:-1, None] + sy[None, 1:-1]) // 4) % 2 == 0
+        surface = pygame.Surface(screen_rect.size, pygame.SRCALPHA)
+        pixels = pygame.surfarray.pixels2d(surface)
+        pixels[edge & dashes] = surface.map_rgb((0, 0, 0, 255)) & 0xFFFFFFFF
+        pixels[edge & ~dashes] = surface.map_rgb((255, 255, 255, 255)) & 0xFFFFFFFF
+        del pixels
+        return surface, screen_rect
+
+
+def trimmed(size, rect, cover):
+    # a selection of cover over rect, cut down to the pixels it selects
+    rows = np.flatnonzero(cover.any(axis=0))
+    cols = np.flatnonzero(cover.any(axis=1))
+    if len(rows) == 0:
+        return Selection(size, (rect.left, rect.top, 0, 0))
+    cover = cover[cols[0]:cols[-1] + 1, rows[0]:rows[-1] + 1]
+    rect = pygame.Rect(rect.left + int(cols[0]), rect.top + int(rows[0]), cover.shape[0], cover.shape[1])
+    if (cover == FULL).all():
+        return Selection(size, rect)
+    return Selection(size, rect, np.ascontiguousarray(cover))
+
+
+def mix(old, new, cover, shifts):
+    # old and new mapped pixels blended by coverage, on premultiplied colour
+    weight = cover.astype(np.float32)[..., None] * (1 / FULL)
+    old = filters.to_float(old, shifts)
+    return filters.to_mapped(old + (filters.to_float(new, shifts) - old) * weight, shifts)
+
+
+def rectangle(size, rect):
+    return Selection(size, pygame.Rect(rect).clip(pygame.Rect((0, 0), size)))
+
+
+def ellipse(size, rect):
+    # the pixels whose centres fall inside the ellipse rect is drawn in
+    rect = pygame.Rect(rect)
+    bounds = rect.clip(pygame.Rect((0, 0), size))
+    if rect.width == 0 or rect.height == 0 or bounds.width == 0 or bounds.height == 0:
+        return Selection(size, (bounds.left, bounds.top, 0, 0))
+    xs = (np.arange(bounds.left, bounds.right) + 0.5 - rect.left - rect.width / 2) / (rect.width / 2)
+    ys = (np.arange(bounds.top, bounds.bottom) + 0.5 - rect.top - rect.height / 2) / (rect.height / 2)
+    inside = xs[:, None] ** 2 + ys[None, :] ** 2 <= 1
+    return trimmed(size, bounds, inside.astype(np.uint8) * FULL)
+
+
+def magic_wand(layer, pos, tolerance=0, connectivity=4):
+    # the region a fill at pos would cover
+    bounds = layer.get_rect()
+    pixels = layer.read(bounds)
+    region = fill.region_mask(fill.match_mask(layer, pixels, pos, tolerance), pos, connectivity)
+    del pixels
+    return trimmed(layer.get_size(), bounds, region.T.astype(np.uint8) * FULL)
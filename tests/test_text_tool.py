@@ -0,0 +1,59 @@
+import pygame
+import pytest
+
+from main import DrawingEngine, SELECT_TOOLS, Tool
+
+
+@pytest.fixture
+def engine():
+    engine = DrawingEngine(64, 64, headless=True)
+    engine.current_tool = Tool.TEXT
+    return engine
+
+
+def type_text(engine, text):
+    for char in text:
+        # pygame's key codes for ASCII keys are their characters' codes
+        engine.handle_keydown(ord(char), char)
+
+
+def test_typing_only_changes_the_text(engine):
+    engine.select("rect", (4, 4), (20, 20))
+    selection = engine.selection
+    settings = engine.settings()
+
+    type_text(engine, "wow jib pop 123")
+
+    assert engine.text_input == "wow jib pop 123"
+    assert engine.current_tool == Tool.TEXT
+    assert engine.selection is selection
+    assert engine.settings() == settings
+
+
+def test_backspace_and_escape(engine):
+    type_text(engine, "hi")
+    engine.handle_keydown(pygame.K_BACKSPACE, "\b")
+    assert engine.text_input == "h"
+
+    engine.handle_keydown(pygame.K_ESCAPE, "\x1b")
+    assert engine.text_input == ""
+    assert engine.current_tool not in SELECT_TOOLS + [Tool.TEXT]
+
+
+def test_typing_leaves_the_layer_alone(engine):
+    layer = engine.layers[engine.active_layer]
+    opacity, blend_mode = layer.opacity, layer.blend_mode
+
+    type_text(engine, "bop")
+
+    assert (layer.opacity, layer.blend_mode) == (opacity, blend_mode)
+    assert engine.history.done == []
+
+
+def test_typing_writes_no_files(engine, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    type_text(engine, "spots")
+    engine.exporter.wait()
+
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,312 @@
+import sys
+
+import numpy as np
+import pygame
+
+TILE_SIZE = 128
+
+
+def _layout():
+    # the byte of each of R, G, B and A within a tile's pixels, and the
+    # matching pygame.image.frombuffer format
+    shifts = pygame.Surface((1, 1), pygame.SRCALPHA).get_shifts()
+    order = [shift // 8 for shift in shifts]
+    if sys.byteorder == "big":
+        order = [3 - i for i in order]
+    return order, "".join("RGBA"[order.index(i)] for i in range(4))
+
+
+ORDER, LAYOUT = _layout()
+
+
+def copy_pixels(source, dest_pos, area, pixels):
+    # add source's pixels inside area onto pixels, a zeroed (height, width)
+    # uint32 array, with area's top-left at dest_pos. Adding onto
+    # transparency copies them exactly and, unlike surfarray or get_at, does
+    # not lock source, which the export thread may be blitting from.
+    # source is anything with blit_to, or a Surface.
+    target = pygame.image.frombuffer(pixels, (pixels.shape[1], pixels.shape[0]), LAYOUT)
+    if isinstance(source, pygame.Surface):
+        target.blit(source, dest_pos, area, pygame.BLEND_RGBA_ADD)
+    else:
+        source.blit_to(target, dest_pos, area, pygame.BLEND_RGBA_ADD)
+
+
+def tile_pixels(tile):
+    # a copy of a tile's pixels indexed [x, y], like surfarray.pixels2d
+    pixels = np.zeros((tile.get_height(), tile.get_width()), dtype=np.uint32)
+    copy_pixels(tile, (0, 0), None, pixels)
+    return pixels.T
+
+
+class TiledLayer:
+    # A transparent layer stored as a sparse grid of SRCALPHA tiles. Tiles
+    # are allocated when something is drawn into them and dropped again when
+    # they become fully transparent; a missing tile is transparent.
+
+    def __init__(self, width, height, tile_size=TILE_SIZE):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.tiles = {}
+        # how the layer is composited onto the ones below it, see blend.py
+        self.opacity = 1.0
+        self.blend_mode = "normal"
+        # tiles of a project file that have not been decoded yet, as
+        # key -> (project, offset, length); they count as present
+        self.sources = {}
+        # tiles whose pixels match a chunk of the last saved project file,
+        # in the same form; anything drawn into drops out of it
+        self.saved = {}
+        # tiles a frozen copy still refers to; they are copied before the
+        # next write instead of when the copy is taken
+        self.shared = set()
+        # blank tiles by size that missing tiles are drawn into first, so
+        # tiles a shape's bounds cross but it never reaches are not kept
+        self._scratch = {}
+        self._region = pygame.Surface((1, 1), pygame.SRCALPHA)
+        self._prototype = pygame.Surface((1, 1), pygame.SRCALPHA)
+        self.shifts = self._prototype.get_shifts()
+
+    def get_size(self):
+        return (self.width, self.height)
+
+    def get_rect(self):
+        return pygame.Rect(0, 0, self.width, self.height)
+
+    def tile_rect(self, key):
+        size = self.tile_size
+        return pygame.Rect(key[0] * size, key[1] * size, size, size).clip(self.get_rect())
+
+    def keys_in(self, rect):
+        rect = pygame.Rect(rect).clip(self.get_rect())
+        if rect.width == 0 or rect.height == 0:
+            return []
+        size = self.tile_size
+        return [
+            (tx, ty)
+            for ty in range(rect.top // size, (rect.bottom - 1) // size + 1)
+            for tx in range(rect.left // size, (rect.right - 1) // size + 1)
+        ]
+
+    def has_tile(self, key):
+        return key in self.tiles or key in self.sources
+
+    def covers(self, rect):
+        # whether any tile is present under rect
+        return any(self.has_tile(key) for key in self.keys_in(rect))
+
+    def keys(self):
+        return list(self.tiles) + list(self.sources)
+
+    def decode(self, key, source):
+        project, offset, length = source
+        return project.read_tile(offset, length, self.tile_rect(key).size)
+
+    def freeze(self):
+        # a copy for reading on another thread that later drawing leaves
+        # alone; it shares tiles with this layer until they are drawn into
+        self.shared = set(self.tiles)
+        layer = TiledLayer(self.width, self.height, self.tile_size)
+        layer.tiles = dict(self.tiles)
+        layer.sources = dict(self.sources)
+        layer.opacity = self.opacity
+        layer.blend_mode = self.blend_mode
+        return layer
+
+    def changed(self, keys):
+        for key in keys:
+            self.saved.pop(key, None)
+
+    def tile(self, key, create=False, write=False):
+        # write=True when the caller is about to change the tile's pixels
+        tile = self.tiles.get(key)
+        if tile is not None and write and key in self.shared:
+            tile = tile.copy()
+            self.tiles[key] = tile
+            self.shared.discard(key)
+        if tile is None and key in self.sources:
+            tile = self.decode(key, self.sources.pop(key))
+            self.tiles[key] = tile
+        if tile is None and create:
+            tile = pygame.Surface(self.tile_rect(key).size, pygame.SRCALPHA)
+            self.tiles[key] = tile
+        return tile
+
+    def prune(self, keys):
+        # drop tiles that no longer hold any visible pixel
+        for key in keys:
+            tile = self.tiles.get(key)
+            if tile is not None and tile.get_bounding_rect().width == 0:
+                del self.tiles[key]
+                self.saved.pop(key, None)
+                self.shared.discard(key)
+
+    def painted_rect(self):
+        keys = self.keys()
+        if not keys:
+            return pygame.Rect(0, 0, 0, 0)
+        rects = [self.tile_rect(key) for key in keys]
+        return rects[0].unionall(rects[1:])
+
+    def keys_under(self, lefts, tops, width, height):
+        # keys of the tiles overlapped by any width x height box with its
+        # top-left at (lefts[i], tops[i])
+        size = self.tile_size
+        columns = -(-self.width // size)
+        rows = -(-self.height // size)
+        first_x, last_x = lefts // size, (lefts + width - 1) // size
+        first_y, last_y = tops // size, (tops + height - 1) // size
+        keys = set()
+        for dx in range(int((last_x - first_x).max()) + 1):
+            for dy in range(int((last_y - first_y).max()) + 1):
+                tx, ty = first_x + dx, first_y + dy
+                valid = (tx <= last_x) & (ty <= last_y) & (tx >= 0) & (tx < columns) & (ty >= 0) & (ty < rows)
+                keys.update(zip(tx[valid].tolist(), ty[valid].tolist()))
+        return sorted(keys, key=lambda key: (key[1], key[0]))
+
+    def draw(self, rect, draw_fn, create=True):
+        return self.draw_keys(self.keys_in(rect), draw_fn, create)
+
+    def draw_keys(self, keys, draw_fn, create=True):
+        # call draw_fn(surface, offset) for every tile in keys, where offset
+        # maps canvas coordinates onto the tile; draw_fn returns the rect it
+        # touched in tile coordinates, or None. With create=False missing
+        # tiles are skipped, for operations that can only remove paint.
+        touched = []
+        existing = []
+        for key in keys:
+            tile_rect = self.tile_rect(key)
+            tile = self.tile(key, write=True)
+            missing = tile is None
+            if missing:
+                if not create:
+                    continue
+                tile = self._scratch.get(tile_rect.size)
+                if tile is None:
+                    tile = pygame.Surface(tile_rect.size, pygame.SRCALPHA)
+            changed = draw_fn(tile, (-tile_rect.x, -tile_rect.y))
+            if changed:
+                changed = pygame.Rect(changed).clip(tile.get_rect())
+            if changed and changed.width and changed.height:
+                touched.append(changed.move(tile_rect.topleft))
+                if not missing:
+                    existing.append(key)
+                elif tile.get_bounding_rect().width:
+                    self.tiles[key] = tile
+                    self.saved.pop(key, None)
+                    self._scratch.pop(tile_rect.size, None)
+                    continue
+            if missing:
+                if changed:
+                    tile.fill((0, 0, 0, 0))
+                self._scratch[tile_rect.size] = tile
+        self.changed(existing)
+        self.prune(existing)
+        if not touched:
+            return None
+        return touched[0].unionall(touched[1:])
+
+    def draw_region(self, rect, draw_fn):
+        # like draw, but draw_fn runs once on a copy of the layer under rect;
+        # pygame clips lines and outlines to the target before rasterising
+        # them, so drawing those tile by tile would shift pixels at the seams
+        rect = pygame.Rect(rect).clip(self.get_rect())
+        if rect.width == 0 or rect.height == 0:
+            return None
+        width, height = self._region.get_size()
+        if rect.width > width or rect.height > height:
+            self._region = pygame.Surface((max(rect.width, width), max(rect.height, height)), pygame.SRCALPHA)
+
+        region = self._region
+        region.set_clip(None)
+        region.fill((0, 0, 0, 0), (0, 0, rect.width, rect.height))
+        self.blit_to(region, (0, 0), rect, pygame.BLEND_RGBA_ADD)
+        region.set_clip((0, 0, rect.width, rect.height))
+        changed = draw_fn(region, (-rect.x, -rect.y))
+        if not changed:
+            return None
+        changed = pygame.Rect(changed).clip(region.get_clip())
+        if changed.width == 0 or changed.height == 0:
+            return None
+
+        pixels = pygame.surfarray.pixels2d(region)
+        self.write(changed.move(rect.topleft), pixels[changed.left:changed.right, changed.top:changed.bottom])
+        del pixels
+        return changed.move(rect.topleft)
+
+    def blit_to(self, dest, dest_pos=(0, 0), area=None, special_flags=0):
+        # draw the part of the layer inside area (the whole layer by default)
+        # onto dest with area's top-left at dest_pos; only present tiles blit
+        area = self.get_rect() if area is None else pygame.Rect(area)
+        for key in self.keys_in(area):
+            tile = self.tile(key)
+            if tile is None:
+                continue
+            tile_rect = self.tile_rect(key)
+            part = tile_rect.clip(area)
+            dest.blit(
+                tile,
+                (part.x - area.x + dest_pos[0], part.y - area.y + dest_pos[1]),
+                part.move(-tile_rect.x, -tile_rect.y),
+                special_flags
+            )
+
+    def blit_layer(self, other):
+        # composite another layer with the same geometry over this one
+        for key in other.keys():
+            self.tile(key, create=True, write=True).blit(other.tile(key), (0, 0))
+        self.changed(other.keys())
+
+    def get_at(self, pos):
+        return self._prototype.unmap_rgb(int(self.read((pos[0], pos[1], 1, 1))[0, 0]))
+
+    def map_rgb(self, color):
+        return self._prototype.map_rgb(color) & 0xFFFFFFFF
+
+    def read(self, rect):
+        # mapped pixels inside rect as a (width, height) uint32 array; the
+        # tiles are not locked, as an export may be blitting them
+        rect = pygame.Rect(rect)
+        pixels = np.zeros((rect.height, rect.width), dtype=np.uint32)
+        if rect.width and rect.height:
+            copy_pixels(self, (0, 0), rect, pixels)
+        return pixels.T
+
+    def write(self, rect, pixels, mask=None):
+        # store pixels (an array shaped like read(rect), or one mapped value)
+        # wherever mask is set; tiles are only created where something lands
+        rect = pygame.Rect(rect)
+        touched = []
+        for key in self.keys_in(rect):
+            tile_rect = self.tile_rect(key)
+            part = tile_rect.clip(rect)
+            src = (slice(part.left - rect.left, part.right - rect.left),
+                   slice(part.top - rect.top, part.bottom - rect.top))
+            dst = (slice(part.left - tile_rect.left, part.right - tile_rect.left),
+                   slice(part.top - tile_rect.top, part.bottom - tile_rect.top))
+            part_mask = None if mask is None else mask[src]
+            values = pixels if np.isscalar(pixels) else pixels[src]
+
+            if part_mask is not None and not part_mask.any():
+                continue
+            if not self.has_tile(key) and np.isscalar(values) and values == 0:
+                continue
+            if not self.has_tile(key) and not np.isscalar(values) and not values.any():
+                continue
+
+            target = pygame.surfarray.pixels2d(self.tile(key, create=True, write=True))
+            if part_mask is None:
+                target[dst] = values
+            elif np.isscalar(values):
+                target[dst][part_mask] = values
+            else:
+                target[dst][part_mask] = values[part_mask]
+            del target
+            touched.append(key)
+        self.changed(touched)
+        self.prune(touched)
+
+    def channels(self, pixels):
+        # split mapped pixels into (r, g, b, a) uint8 arrays
+        return [((pixels >> shift) & 0xFF).astype(np.uint8) for shift in self.shifts]
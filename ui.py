@@ -0,0 +1,26 @@
+from collections import OrderedDict
+
+import pygame
+
+
+class TextCache:
+    # rendered strings by (font, text, colour, scale), least recently used
+    # dropped first; the surfaces are shared, so callers must not draw on them
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.surfaces = OrderedDict()
+
+    def render(self, font, text, color, scale=1):
+        key = (font, text, tuple(color), scale)
+        surface = self.surfaces.get(key)
+        if surface is None:
+            if scale == 1:
+                surface = font.render(text, True, color)
+            else:
+                surface = pygame.transform.scale_by(self.render(font, text, color), scale)
+            self.surfaces[key] = surface
+            if len(self.surfaces) > self.capacity:
+                self.surfaces.popitem(last=False)
+        else:
+            self.surfaces.move_to_end(key)
+        return surface
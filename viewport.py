@@ -0,0 +1,83 @@
+import math
+
+import pygame
+
+# zoom is 2 ** step: zoomed out, whole mip levels are shown 1:1 and zoomed
+# in, document pixels are scaled by whole numbers, so nothing is resampled
+# at fractional sizes and tiles always meet on exact screen pixels
+MIN_STEP = -6
+MAX_STEP = 5
+
+
+class Viewport:
+    def __init__(self, window_size, document_size):
+        self.window = pygame.Rect((0, 0), window_size)
+        self.document = pygame.Rect((0, 0), document_size)
+        self.step = 0
+        # screen position of the document's top-left corner
+        self.origin = (0, 0)
+
+    @property
+    def zoom(self):
+        return 2.0 ** self.step
+
+    @property
+    def level(self):
+        # the mip level shown 1:1 when zoomed out, 0 otherwise
+        return max(0, -self.step)
+
+    def key(self):
+        return (self.step, self.origin)
+
+    def to_document(self, pos):
+        return (
+            math.floor((pos[0] - self.origin[0]) / self.zoom),
+            math.floor((pos[1] - self.origin[1]) / self.zoom),
+        )
+
+    def to_screen(self, pos):
+        return (
+            math.floor(self.origin[0] + pos[0] * self.zoom),
+            math.floor(self.origin[1] + pos[1] * self.zoom),
+        )
+
+    def to_screen_rect(self, rect):
+        left, top = self.to_screen(rect.topleft)
+        right = math.ceil(self.origin[0] + rect.right * self.zoom)
+        bottom = math.ceil(self.origin[1] + rect.bottom * self.zoom)
+        return pygame.Rect(left, top, right - left, bottom - top)
+
+    def to_document_rect(self, rect):
+        left, top = self.to_document(rect.topleft)
+        right = math.ceil((rect.right - self.origin[0]) / self.zoom)
+        bottom = math.ceil((rect.bottom - self.origin[1]) / self.zoom)
+        return pygame.Rect(left, top, right - left, bottom - top)
+
+    def visible_rect(self):
+        return self.to_document_rect(self.window).clip(self.document)
+
+    def pan(self, dx, dy):
+        self.origin = (self.origin[0] + dx, self.origin[1] + dy)
+        self.clamp()
+
+    def zoom_at(self, pos, steps):
+        # keep the document point under pos where it is
+        step = max(MIN_STEP, min(MAX_STEP, self.step + steps))
+        if step == self.step:
+            return
+        x = (pos[0] - self.origin[0]) / self.zoom
+        y = (pos[1] - self.origin[1]) / self.zoom
+        self.step = step
+        self.origin = (round(pos[0] - x * self.zoom), round(pos[1] - y * self.zoom))
+        self.clamp()
+
+    def reset(self):
+        self.step = 0
+        self.origin = (0, 0)
+
+    def clamp(self, margin=64):
+        # keep at least margin pixels of the document on screen
+        size = self.to_screen_rect(self.document).size
+        left = min(self.window.width - margin, max(margin - size[0], self.origin[0]))
+        top = min(self.window.height - margin, max(margin - size[1], self.origin[1]))
+        self.origin = (left, top)